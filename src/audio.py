@@ -1,14 +1,23 @@
 import asyncio
+import logging
 import pyaudio
-import queue
 import os
 import numpy as np
+import re
 import subprocess
-from typing import Optional
-from scipy.signal import resample_poly
-from audioprocessor import AudioProcessor
+import time
+from typing import Optional, Callable
+from audioprocessor import AudioProcessor, FrameTap, TAP_PROCESSED
+from ringbuffer import RingBuffer, DROP_NEWEST, OVERWRITE
+from resampler import StreamingResampler
+from ducking import HardwareMixer
+from metrics import metrics
 
 ALSA_AVAILABLE = os.name != 'nt'
+# Also duck the hardware capture volume, on top of the software ducking in the processor
+CAPTURE_DUCK_HARDWARE = os.getenv('CAPTURE_DUCK_HARDWARE', '0') == '1'
+CAPTURE_VOLUME_PERCENT = 90
+CAPTURE_DUCKED_VOLUME_PERCENT = 40
 
 DEVICE_INDEX = 0 if os.name != 'nt' else None
 FORMAT = pyaudio.paInt16
@@ -16,30 +25,102 @@ FORMAT_BYTE_LENGTH = 2
 CHANNELS = 1
 SAMPLE_RATE = 16000
 FRAME_SIZE = 1024
+PLAYOUT_BUFFER_SECONDS = 64
+DEFAULT_SERVER_SAMPLE_RATE = 24000
+PREROLL_SECONDS = float(os.getenv('PREROLL_SECONDS', '3'))
+# Where a session starts relative to the end of the wake word, negative values start earlier
+PREROLL_OFFSET_SAMPLES = int(os.getenv('PREROLL_OFFSET_MS', '0')) * SAMPLE_RATE // 1000
+CAPTURE_READ_MAX_SAMPLES = SAMPLE_RATE
 
 
-class Audio:
+def parse_pcm_sample_rate(mime_type: Optional[str], default: int = DEFAULT_SERVER_SAMPLE_RATE) -> int:
+  match = re.search(r'rate=(\d+)', mime_type or '')
+  return int(match.group(1)) if match else default
+
+
+class AudioCapture:
+  # Processed capture audio as seen by the rest of the node: a pre-roll history ring with
+  # absolute sample positions, capture listeners and readers. Shared by the in-process
+  # Audio and the separate process audio engine.
   def __init__(self) -> None:
+    self._capture_ring = RingBuffer(int(PREROLL_SECONDS * SAMPLE_RATE), max_read=1, overflow_policy=OVERWRITE)
+    self._capture_clock = (0, time.time())
+    self._capture_listeners: list[Callable[[bytes, int], None]] = []
+
+  def add_capture_listener(self, listener: Callable[[bytes, int], None]) -> None:
+    self._capture_listeners.append(listener)
+
+  def add_tap_listener(self, stage: str, frame_size: int, listener: Callable[[bytes, int], None]) -> None:
+    # Frames of frame_size samples from a stage of the capture path (audioprocessor.TAP_STAGES),
+    # with positions in the capture ring. Only processed capture reaches this process here.
+    if stage != TAP_PROCESSED:
+      logging.warning(f'Capture tap {stage} is not available, using processed capture')
+    self.add_capture_listener(FrameTap(frame_size, listener).push)
+
+  def _capture_frame(self, frame: bytes, _position: Optional[int] = None) -> None:
+    # Listeners get the position of the frame in the capture ring, not in the processor output
+    position = self._capture_ring.write_position
+    samples = np.frombuffer(frame, dtype=np.int16)
+    self._capture_ring.write(samples)
+    self._capture_clock = (position + len(samples), time.time())
+    for listener in self._capture_listeners:
+      listener(frame, position)
+
+  @property
+  def capture_position(self) -> int:
+    return self._capture_ring.write_position
+
+  def capture_time(self, position: int) -> float:
+    clock_position, clock_time = self._capture_clock
+    return clock_time - (clock_position - position) / SAMPLE_RATE
+
+  def open_capture_reader(self, start_position: Optional[int] = None) -> 'CaptureReader':
+    return CaptureReader(self, self._capture_ring, self.capture_position if start_position is None else start_position)
+
+
+class Audio(AudioCapture):
+  def __init__(self, playout_ring: Optional[RingBuffer] = None) -> None:
+    super().__init__()
     self._pya = pyaudio.PyAudio()
     self._audio_stream: Optional[pyaudio.Stream] = None
-    self._micraw_queue: queue.Queue[bytes] = queue.Queue(maxsize=100)
-    self._speaker_buffer = AudioFrameBuffer(FRAME_SIZE, FORMAT_BYTE_LENGTH, SAMPLE_RATE)
+    self._speaker_buffer = AudioFrameBuffer(FRAME_SIZE, FORMAT_BYTE_LENGTH, SAMPLE_RATE, ring=playout_ring)
     self._processor = AudioProcessor(sample_rate=SAMPLE_RATE)
-    self._mic_queue: queue.Queue[bytes] = self._processor._output_queue
-    self._last_volume_is_playing: Optional[bool] = None
+    self._processor.warm_up()
+    self._mixer: Optional[HardwareMixer] = None
+    if ALSA_AVAILABLE and CAPTURE_DUCK_HARDWARE:
+      self._mixer = HardwareMixer('Capture')
+      self._processor.ducker.add_listener(self._set_hardware_ducking)
+    self._processor.add_output_listener(self._capture_frame)
 
-  def _audio_callback(self, in_data: bytes, _frame_count: int, _time_info: dict, _status: int) -> tuple[bytes, int]:
-    is_buffer_empty = self._speaker_buffer.is_empty()
-    if is_buffer_empty:
-      far_end = b'\x00' * FRAME_SIZE * FORMAT_BYTE_LENGTH
-    else:
-      far_end = self._speaker_buffer.get_frame()
+    self._callback_time = metrics.histogram('audio.callback_ms')
+    self._input_overflows = metrics.counter('audio.input_overflows')
+    self._input_underflows = metrics.counter('audio.input_underflows')
+    self._output_underflows = metrics.counter('audio.output_underflows')
+    self._output_overflows = metrics.counter('audio.output_overflows')
+    metrics.add_source('audio.playout', self._speaker_buffer.get_stats)
+    metrics.add_source('audio.processor', self._processor.get_stats)
+
+  def _audio_callback(self, in_data: bytes, _frame_count: int, _time_info: dict, status: int) -> tuple[np.ndarray, int]:
+    start = time.perf_counter()
+    if status:
+      self._record_status(status)
+    far_end = self._speaker_buffer.get_frame()
 
     self._processor.submit(in_data, far_end)
-    self._adjust_capture_volume(not is_buffer_empty)
 
+    self._callback_time.observe_since(start)
     return (far_end, pyaudio.paContinue)
 
+  def _record_status(self, status: int) -> None:
+    if status & pyaudio.paInputOverflow:
+      self._input_overflows.inc()
+    if status & pyaudio.paInputUnderflow:
+      self._input_underflows.inc()
+    if status & pyaudio.paOutputUnderflow:
+      self._output_underflows.inc()
+    if status & pyaudio.paOutputOverflow:
+      self._output_overflows.inc()
+
   async def setup_streams(self) -> None:
     self._audio_stream = await asyncio.to_thread(
       self._pya.open,
@@ -54,10 +135,15 @@ class Audio:
       stream_callback=self._audio_callback
     )
     if ALSA_AVAILABLE:
-      subprocess.run(['alsactl', 'restore', '-f', 'asound.state'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+      # In a thread so the rest of startup keeps running on the event loop
+      await asyncio.to_thread(subprocess.run, ['alsactl', 'restore', '-f', 'asound.state'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
 
-  async def read_data(self) -> bytes:
-    return await asyncio.to_thread(self._mic_queue.get, timeout=1)
+  def close(self) -> None:
+    if self._audio_stream:
+      self._audio_stream.stop_stream()
+      self._audio_stream.close()
+      self._audio_stream = None
+    self._pya.terminate()
 
   def write_16khz_data(self, data: bytes) -> None:
     self._speaker_buffer.write_16khz_data(data)
@@ -65,56 +151,113 @@ class Audio:
   def write_24khz_data(self, data: bytes) -> None:
     self._speaker_buffer.write_24khz_data(data)
 
+  def write_data(self, data: bytes, sample_rate: int) -> None:
+    self._speaker_buffer.write_data(data, sample_rate)
+
   def stop_output_immediately(self) -> None:
     self._speaker_buffer.clear()
 
-  def _adjust_capture_volume(self, is_playing: bool) -> None:
-    if self._last_volume_is_playing == is_playing:
-      return
-    self._last_volume_is_playing = is_playing
-    volume_percent = 40 if is_playing else 90
-    print(f'setting capture volume to {volume_percent}%')
-    if ALSA_AVAILABLE:
-      subprocess.Popen(['amixer', 'set', '-c', '0', 'Capture', f'{volume_percent}%'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  def playout_level(self) -> float:
+    return self._speaker_buffer.fill_level()
+
+  def add_tap_listener(self, stage: str, frame_size: int, listener: Callable[[bytes, int], None]) -> None:
+    # Processor output positions are capture ring positions, the ring stores every output frame
+    self._processor.add_tap_listener(stage, frame_size, listener)
+
+  def _set_hardware_ducking(self, ducked: bool) -> None:
+    self._mixer.set_volume(CAPTURE_DUCKED_VOLUME_PERCENT if ducked else CAPTURE_VOLUME_PERCENT)
+
+
+
+class CaptureReader:
+  # Cursor over the pre-roll capture ring. Reads return everything captured since the last
+  # read (up to a second at a time), so a backlog is flushed as fast as the caller can take it.
+  def __init__(self, audio: AudioCapture, ring: RingBuffer, position: int) -> None:
+    self._audio = audio
+    self._ring = ring
+    self.position = position
+    self.skipped_samples = 0
+
+  async def read(self) -> tuple[bytes, float]:
+    while True:
+      start, samples = self._ring.read_history(self.position, CAPTURE_READ_MAX_SAMPLES)
+      # start is clamped back to the write position when reading ahead of the capture
+      self.skipped_samples += max(0, start - self.position)
+      if len(samples):
+        self.position = start + len(samples)
+        return samples.tobytes(), self._audio.capture_time(start)
+      await asyncio.to_thread(self._ring.wait_for_position, self.position, 1)
 
 
 
 class AudioFrameBuffer:
-  def __init__(self, frame_size: int, format_byte_length: int, sample_rate: int) -> None:
+  # The ring can be shared with another process, one side writing and the other playing out
+  def __init__(self, frame_size: int, format_byte_length: int, sample_rate: int, ring: Optional[RingBuffer] = None) -> None:
     self._frame_size = frame_size
     self._format_byte_length = format_byte_length
     self._sample_rate = sample_rate
-    self._queue: queue.Queue[bytes] = queue.Queue(maxsize=1000)
-    self._remainder = b''
-    self._24khz_resample_buffer = b''
+    self._ring = ring or RingBuffer(int(PLAYOUT_BUFFER_SECONDS * sample_rate), max_read=frame_size, overflow_policy=DROP_NEWEST)
+    self._frame = np.zeros(frame_size, dtype=np.int16)
+    self._partial_byte = b''
+    self._resamplers: dict[int, StreamingResampler] = {}
+    self._last_frame_full = False
+    self.underruns = 0
+    self.underrun_samples = 0
+
+  def _to_samples(self, data: bytes) -> np.ndarray:
+    if self._partial_byte:
+      data = self._partial_byte + data
+    usable_bytes = len(data) - len(data) % self._format_byte_length
+    self._partial_byte = data[usable_bytes:]
+    return np.frombuffer(data, dtype=np.int16, count=usable_bytes // self._format_byte_length)
+
+  def write_data(self, data: bytes, sample_rate: int) -> None:
+    samples = self._to_samples(data)
+    if sample_rate != self._sample_rate:
+      if sample_rate not in self._resamplers:
+        self._resamplers[sample_rate] = StreamingResampler(sample_rate, self._sample_rate)
+      samples = self._resamplers[sample_rate].process(samples)
+    self._ring.write(samples)
 
   def write_16khz_data(self, data: bytes) -> None:
-    data = self._remainder + data
-    chunk_bytes = self._frame_size * self._format_byte_length
-    while len(data) >= chunk_bytes:
-      self._queue.put_nowait(data[:chunk_bytes])
-      data = data[chunk_bytes:]
-    self._remainder = data
+    self.write_data(data, 16000)
 
   def write_24khz_data(self, data: bytes) -> None:
-    resample_ratio = self._sample_rate / 24000
-    arr = np.frombuffer(self._24khz_resample_buffer + data, dtype=np.int16)
-    resampled_arr = resample_poly(arr, up=2, down=3)
-    resampled = resampled_arr.astype(np.int16).tobytes()
-
-    expected_resampled_bytes = int(len(data) * resample_ratio)
-    self.write_16khz_data(resampled[-expected_resampled_bytes:])
-    self._24khz_resample_buffer = data
+    self.write_data(data, 24000)
 
   def clear(self) -> None:
-    while not self._queue.empty():
-      self._queue.get_nowait()
+    self._ring.clear()
+    self._partial_byte = b''
+    for resampler in self._resamplers.values():
+      resampler.reset()
 
-  def get_frame(self) -> bytes:
-    return self._queue.get_nowait()
+  def get_frame(self) -> np.ndarray:
+    # Always fills the same preallocated frame, padding with silence when the ring cannot
+    # supply a full frame. The returned array is only valid until the next call.
+    available = min(self._ring.available, self._frame_size)
+    if available > 0:
+      self._frame[:available] = self._ring.peek(available)
+      self._ring.consume(available)
+    self._frame[available:] = 0
 
-  def is_empty(self) -> bool:
-    return self._queue.empty()
+    if available < self._frame_size and self._last_frame_full:
+      self.underruns += 1
+      self.underrun_samples += self._frame_size - available
+    self._last_frame_full = available == self._frame_size
+    return self._frame
 
+  def is_empty(self) -> bool:
+    return self._ring.available == 0
 
+  def fill_level(self) -> float:
+    return self._ring.available / self._sample_rate
 
+  def get_stats(self) -> dict[str, float]:
+    ring_stats = self._ring.get_stats()
+    return {
+      'fill_level_s': self.fill_level(),
+      'underruns': self.underruns,
+      'underrun_samples': self.underrun_samples,
+      'overruns': ring_stats['overflows'],
+      'dropped_samples': ring_stats['dropped_samples'],
+    }
@@ -0,0 +1,181 @@
+import struct
+import numpy as np
+from abc import ABC, abstractmethod
+from typing import Dict
+
+IMA_BLOCK_SAMPLES = 64
+IMA_BLOCK_HEADER = struct.Struct('<hBx')
+IMA_INDEX_TABLE = np.array([-1, -1, -1, -1, 2, 4, 6, 8] * 2, dtype=np.int32)
+IMA_STEP_TABLE = np.array([
+  7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+  50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307,
+  337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066,
+  2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899,
+  15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767,
+], dtype=np.int32)
+
+# Reconstructed step delta for every (step index, 3-bit code) pair, as the decoder computes it
+_steps = IMA_STEP_TABLE[:, np.newaxis]
+_codes = np.arange(8)[np.newaxis, :]
+IMA_DELTA_TABLE = (_steps >> 3) + np.where(_codes & 4, _steps, 0) + np.where(_codes & 2, _steps >> 1, 0) + np.where(_codes & 1, _steps >> 2, 0)
+# The encoder's per-sample state is index * 16, so adding a 4-bit code looks up the signed
+# delta and the next state in one flat table each
+_signed_codes = np.arange(16)
+IMA_SIGNED_DELTA_TABLE = np.where(_signed_codes & 8, -IMA_DELTA_TABLE[:, _signed_codes & 7], IMA_DELTA_TABLE[:, _signed_codes & 7]).reshape(-1)
+IMA_NEXT_STATE_TABLE = (np.clip(np.arange(len(IMA_STEP_TABLE))[:, np.newaxis] + IMA_INDEX_TABLE[np.newaxis, :], 0, len(IMA_STEP_TABLE) - 1) * 16).reshape(-1)
+IMA_STATE_STEP_TABLE = np.repeat(IMA_STEP_TABLE, 16)
+
+MULAW_BIAS = 0x84
+MULAW_CLIP = 8159
+MULAW_SEGMENT_ENDS = np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF])
+
+
+class AudioCodec(ABC):
+  codec_id: int
+  name: str
+
+  @abstractmethod
+  def encode(self, samples: np.ndarray) -> bytes:
+    pass
+
+  @abstractmethod
+  def decode(self, data: bytes) -> np.ndarray:
+    pass
+
+
+class PcmCodec(AudioCodec):
+  codec_id = 0
+  name = 'pcm'
+
+  def encode(self, samples: np.ndarray) -> bytes:
+    return samples.astype('<i2').tobytes()
+
+  def decode(self, data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype='<i2').astype(np.int16)
+
+
+def _mulaw_encode_reference(samples: np.ndarray) -> np.ndarray:
+  # Same 14-bit G.711 algorithm as the classic CCITT reference (and audioop.lin2ulaw)
+  shifted = samples.astype(np.int32) >> 2
+  mask = np.where(shifted < 0, 0x7F, 0xFF)
+  magnitude = np.minimum(np.abs(shifted), MULAW_CLIP) + (MULAW_BIAS >> 2)
+  segment = np.searchsorted(MULAW_SEGMENT_ENDS, magnitude)
+  value = np.where(segment >= 8, 0x7F, (segment << 4) | ((magnitude >> (segment + 1)) & 0x0F))
+  return (value ^ mask).astype(np.uint8)
+
+
+def _mulaw_decode_reference(data: np.ndarray) -> np.ndarray:
+  data = ~data.astype(np.int32) & 0xFF
+  exponent = (data >> 4) & 0x07
+  magnitude = (((data & 0x0F) << 3) + MULAW_BIAS) << exponent
+  return np.where(data & 0x80, MULAW_BIAS - magnitude, magnitude - MULAW_BIAS).astype(np.int16)
+
+
+class MuLawCodec(AudioCodec):
+  # G.711 mu-law through lookup tables indexed by the raw sample bits
+  codec_id = 1
+  name = 'mulaw'
+
+  _encode_table = _mulaw_encode_reference(np.arange(65536, dtype=np.uint16).view(np.int16))
+  _decode_table = _mulaw_decode_reference(np.arange(256, dtype=np.uint8))
+
+  def encode(self, samples: np.ndarray) -> bytes:
+    return self._encode_table[samples.astype(np.int16).view(np.uint16)].tobytes()
+
+  def decode(self, data: bytes) -> np.ndarray:
+    return self._decode_table[np.frombuffer(data, dtype=np.uint8)]
+
+
+class ImaAdpcmCodec(AudioCodec):
+  # IMA-ADPCM in independent blocks, each starting with the raw first sample and step index
+  # like WAV IMA-ADPCM. The recurrence is sequential within a block, so all blocks of a
+  # packet are encoded in parallel as numpy lanes. The payload starts with the sample count.
+  codec_id = 2
+  name = 'ima_adpcm'
+
+  def __init__(self, block_samples: int = IMA_BLOCK_SAMPLES) -> None:
+    if block_samples % 2 != 0 or block_samples < 2:
+      raise ValueError('block_samples must be an even number of at least 2')
+    self.block_samples = block_samples
+
+  def encode(self, samples: np.ndarray) -> bytes:
+    n_samples = len(samples)
+    n_blocks = -(-n_samples // self.block_samples)
+    blocks = np.zeros(n_blocks * self.block_samples, dtype=np.int32)
+    blocks[:n_samples] = samples
+    blocks = blocks.reshape(n_blocks, self.block_samples)
+
+    # Blocks cannot inherit the step index of the previous block, so start each one at the
+    # step closest to its average sample delta instead of the smallest step
+    mean_delta = np.mean(np.abs(np.diff(blocks, axis=1)), axis=1)
+    initial_index = np.minimum(np.searchsorted(IMA_STEP_TABLE, mean_delta), len(IMA_STEP_TABLE) - 1)
+    # One row per sample position, so each step of the recurrence reads and writes contiguous
+    # lanes. The steps run as in-place ufuncs against lane-sized constants, since converting
+    # Python scalars costs more than the arithmetic on a packet's few dozen lanes.
+    columns = np.ascontiguousarray(blocks.T, dtype=np.intp)
+    codes = np.zeros((self.block_samples, n_blocks), dtype=np.intp)
+    predictor = columns[0].copy()
+    state = initial_index * 16
+    diff = np.empty(n_blocks, dtype=np.intp)
+    two, seven, eight, sign_shift = (np.full(n_blocks, value, dtype=np.intp) for value in (2, 7, 8, np.iinfo(np.intp).bits - 1))
+    low, high = np.full(n_blocks, -32768, dtype=np.intp), np.full(n_blocks, 32767, dtype=np.intp)
+    for i in range(1, self.block_samples):
+      code = codes[i]
+      np.subtract(columns[i], predictor, out=diff)
+      # Magnitude min(4 * |diff| // step, 7), plus 8 from the sign bit when negative
+      np.abs(diff, out=code)
+      np.left_shift(code, two, out=code)
+      np.floor_divide(code, IMA_STATE_STEP_TABLE[state], out=code)
+      np.minimum(code, seven, out=code)
+      np.right_shift(diff, sign_shift, out=diff)
+      np.bitwise_and(diff, eight, out=diff)
+      np.add(code, diff, out=code)
+
+      np.add(state, code, out=state)
+      np.add(predictor, IMA_SIGNED_DELTA_TABLE[state], out=predictor)
+      np.maximum(predictor, low, out=predictor)
+      np.minimum(predictor, high, out=predictor)
+      state = IMA_NEXT_STATE_TABLE[state]
+    codes = codes.T
+
+    # Code 0 is padding so each block packs to block_samples / 2 bytes
+    packed = (codes[:, 0::2] | (codes[:, 1::2] << 4)).astype(np.uint8)
+    headers = np.zeros(n_blocks, dtype=[('first', '<i2'), ('index', 'u1'), ('pad', 'u1')])
+    headers['first'] = blocks[:, 0]
+    headers['index'] = initial_index
+    payload = np.concatenate([headers.view(np.uint8).reshape(n_blocks, IMA_BLOCK_HEADER.size), packed], axis=1)
+    return struct.pack('<I', n_samples) + payload.tobytes()
+
+  def decode(self, data: bytes) -> np.ndarray:
+    (n_samples,) = struct.unpack_from('<I', data)
+    block_bytes = IMA_BLOCK_HEADER.size + self.block_samples // 2
+    raw = np.frombuffer(data, dtype=np.uint8, offset=4).reshape(-1, block_bytes)
+    n_blocks = len(raw)
+    headers = raw[:, :IMA_BLOCK_HEADER.size].copy().view([('first', '<i2'), ('index', 'u1'), ('pad', 'u1')]).reshape(n_blocks)
+    packed = raw[:, IMA_BLOCK_HEADER.size:]
+    codes = np.empty((n_blocks, self.block_samples), dtype=np.int32)
+    codes[:, 0::2] = packed & 0x0F
+    codes[:, 1::2] = packed >> 4
+
+    output = np.empty((n_blocks, self.block_samples), dtype=np.int16)
+    predictor = headers['first'].astype(np.int32)
+    index = headers['index'].astype(np.int32)
+    output[:, 0] = predictor
+    max_index = len(IMA_STEP_TABLE) - 1
+    for i in range(1, self.block_samples):
+      code = codes[:, i]
+      magnitude = code & 7
+      delta = IMA_DELTA_TABLE[index, magnitude]
+      predictor = np.clip(np.where(code & 8, predictor - delta, predictor + delta), -32768, 32767)
+      index = np.clip(index + IMA_INDEX_TABLE[magnitude], 0, max_index)
+      output[:, i] = predictor
+    return output.reshape(-1)[:n_samples]
+
+
+CODECS: Dict[str, AudioCodec] = {codec.name: codec for codec in (PcmCodec(), MuLawCodec(), ImaAdpcmCodec())}
+
+
+def get_codec(name: str) -> AudioCodec:
+  if name not in CODECS:
+    raise ValueError(f'Unknown audio codec: {name}')
+  return CODECS[name]
@@ -0,0 +1,204 @@
+import asyncio
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import numpy as np
+from multiprocessing.connection import Connection
+from typing import Any, Dict, Optional
+from audio import AudioCapture, AudioFrameBuffer, FRAME_SIZE, FORMAT_BYTE_LENGTH, SAMPLE_RATE, PLAYOUT_BUFFER_SECONDS
+from ringbuffer import SharedRingBuffer, DROP_OLDEST, DROP_NEWEST
+from metrics import metrics
+
+# Run PortAudio, AEC, ducking and NR in their own process instead of the VoiceNode process
+AUDIO_ENGINE_PROCESS = os.getenv('AUDIO_ENGINE_PROCESS', '0') == '1'
+ENGINE_CAPTURE_RING_SECONDS = 2.0
+# Spawning the engine imports numpy, scipy and speexdsp from scratch, which is slow on a Pi 3
+ENGINE_START_TIMEOUT_S = 30.0
+ENGINE_STOP_TIMEOUT_S = 5.0
+ENGINE_STATS_INTERVAL_S = 1.0
+
+
+def run_engine(control: Connection, capture_ring: SharedRingBuffer, playout_ring: SharedRingBuffer) -> None:
+  # Entry point of the engine process. Processed capture is written to capture_ring and
+  # playout is read from playout_ring. The control pipe carries ('stop',) from the
+  # VoiceNode process and ('ready', info) / ('stats', snapshot) back to it.
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s - engine - %(message)s')
+  from audio import Audio
+
+  audio = Audio(playout_ring=playout_ring)
+  audio.add_capture_listener(lambda frame, _position: capture_ring.write(np.frombuffer(frame, dtype=np.int16)))
+  asyncio.run(audio.setup_streams())
+  control.send(('ready', {'output_frame_size': audio._processor.output_frame_size, 'pid': os.getpid()}))
+
+  stopped = threading.Event()
+  stats_thread = threading.Thread(target=_send_engine_stats, args=(control, stopped), daemon=True)
+  stats_thread.start()
+  try:
+    while True:
+      message = control.recv()
+      if message[0] == 'stop':
+        break
+  except (EOFError, OSError):
+    logging.warning('VoiceNode process went away, stopping audio engine')
+  finally:
+    stopped.set()
+    stats_thread.join()
+    audio.close()
+    capture_ring.close()
+    playout_ring.close()
+    control.close()
+
+
+def _send_engine_stats(control: Connection, stopped: threading.Event) -> None:
+  while not stopped.wait(ENGINE_STATS_INTERVAL_S):
+    try:
+      control.send(('stats', metrics.snapshot()))
+    except (OSError, ValueError):
+      return
+
+
+class EngineAudio(AudioCapture):
+  # Same interface as Audio, backed by an audio engine process so the PortAudio callback
+  # and the DSP get their own interpreter and core. Processed capture arrives through a
+  # shared memory ring and is pumped into the local pre-roll ring and capture listeners;
+  # playout is resampled here and written straight into the ring the engine plays from.
+  # The engine is restarted if it dies.
+  def __init__(self) -> None:
+    super().__init__()
+    self._context = multiprocessing.get_context('spawn')
+    self._process: Optional[multiprocessing.process.BaseProcess] = None
+    self._control: Optional[Connection] = None
+    self._engine_capture_ring: Optional[SharedRingBuffer] = None
+    self._playout_ring: Optional[SharedRingBuffer] = None
+    self._speaker_buffer: Optional[AudioFrameBuffer] = None
+    # Held while the speaker buffer is used so _stop can't close the playout ring under a writer
+    self._speaker_lock = threading.Lock()
+    self._threads: list[threading.Thread] = []
+    self._frame_size = 0
+    self._lifecycle_lock = threading.Lock()
+    self._closing = False
+    self.restarts = 0
+    self.engine_stats: Dict[str, Any] = {}
+    metrics.add_source('engine', lambda: self.engine_stats)
+    atexit.register(self.close)
+
+  async def setup_streams(self) -> None:
+    await asyncio.to_thread(self._start)
+
+  def _start(self) -> None:
+    with self._lifecycle_lock:
+      capture_ring = SharedRingBuffer(int(ENGINE_CAPTURE_RING_SECONDS * SAMPLE_RATE), max_read=SAMPLE_RATE, overflow_policy=DROP_OLDEST, context=self._context)
+      playout_ring = SharedRingBuffer(int(PLAYOUT_BUFFER_SECONDS * SAMPLE_RATE), max_read=FRAME_SIZE, overflow_policy=DROP_NEWEST, context=self._context)
+      control, engine_control = self._context.Pipe()
+      process = self._context.Process(target=run_engine, args=(engine_control, capture_ring, playout_ring), name='audio-engine', daemon=True)
+      start = time.monotonic()
+      process.start()
+      engine_control.close()
+      try:
+        if not control.poll(ENGINE_START_TIMEOUT_S):
+          raise RuntimeError('Audio engine did not start in time')
+        _, info = control.recv()
+      except (EOFError, RuntimeError):
+        process.terminate()
+        process.join()
+        control.close()
+        capture_ring.close()
+        playout_ring.close()
+        raise RuntimeError(f'Audio engine failed to start (exit code {process.exitcode})')
+
+      self._frame_size = info['output_frame_size']
+      self._process, self._control = process, control
+      self._engine_capture_ring, self._playout_ring = capture_ring, playout_ring
+      with self._speaker_lock:
+        self._speaker_buffer = AudioFrameBuffer(FRAME_SIZE, FORMAT_BYTE_LENGTH, SAMPLE_RATE, ring=playout_ring)
+      self._threads = [
+        threading.Thread(target=self._capture_loop, args=(capture_ring,), daemon=True),
+        threading.Thread(target=self._control_loop, args=(control,), daemon=True),
+      ]
+      for thread in self._threads:
+        thread.start()
+      logging.info(f'Audio engine started in {time.monotonic() - start:.1f}s (pid {info["pid"]})')
+
+  def _stop(self) -> None:
+    with self._lifecycle_lock:
+      process, control = self._process, self._control
+      capture_ring, playout_ring = self._engine_capture_ring, self._playout_ring
+      if not process:
+        return
+      # Clearing these first tells the capture and control threads to finish
+      self._process = self._control = None
+      self._engine_capture_ring = self._playout_ring = None
+      with self._speaker_lock:
+        self._speaker_buffer = None
+
+      try:
+        control.send(('stop',))
+      except (OSError, ValueError):
+        pass
+      process.join(ENGINE_STOP_TIMEOUT_S)
+      if process.is_alive():
+        logging.warning('Audio engine did not stop, terminating it')
+        process.terminate()
+        process.join()
+      for thread in self._threads:
+        if thread is not threading.current_thread():
+          thread.join()
+      control.close()
+      capture_ring.close()
+      playout_ring.close()
+
+  def restart(self) -> None:
+    self._stop()
+    self._start()
+    self.restarts += 1
+
+  def close(self) -> None:
+    self._closing = True
+    self._stop()
+
+  def _capture_loop(self, ring: SharedRingBuffer) -> None:
+    while self._engine_capture_ring is ring:
+      if not ring.wait(self._frame_size, timeout=0.5):
+        continue
+      frame = ring.peek(self._frame_size).tobytes()
+      ring.consume(self._frame_size)
+      self._capture_frame(frame)
+
+  def _control_loop(self, control: Connection) -> None:
+    while True:
+      try:
+        kind, payload = control.recv()
+      except (EOFError, OSError):
+        break
+      if kind == 'stats':
+        self.engine_stats = payload
+
+    if self._control is control and not self._closing:
+      logging.error('Audio engine exited unexpectedly, restarting it')
+      try:
+        self.restart()
+      except RuntimeError as e:
+        logging.error(f'Failed to restart audio engine: {e}')
+
+  def write_16khz_data(self, data: bytes) -> None:
+    self.write_data(data, 16000)
+
+  def write_24khz_data(self, data: bytes) -> None:
+    self.write_data(data, 24000)
+
+  def write_data(self, data: bytes, sample_rate: int) -> None:
+    with self._speaker_lock:
+      if self._speaker_buffer:
+        self._speaker_buffer.write_data(data, sample_rate)
+
+  def stop_output_immediately(self) -> None:
+    with self._speaker_lock:
+      if self._speaker_buffer:
+        self._speaker_buffer.clear()
+
+  def playout_level(self) -> float:
+    with self._speaker_lock:
+      return self._speaker_buffer.fill_level() if self._speaker_buffer else 0.0
@@ -1,8 +1,14 @@
+import logging
 import numpy as np
-import queue
+import os
 import threading
-from typing import Optional
-from noisereduce.spectralgate.nonstationary import SpectralGateNonStationary
+import time
+from typing import Optional, Callable
+from noise_suppression import NoiseSuppressor, create_noise_suppressor
+from ringbuffer import RingBuffer, DROP_OLDEST, DROP_NEWEST
+from ducking import CaptureDucker
+from delay_estimator import DelayEstimator, DelayLine
+from metrics import metrics
 
 
 try:
@@ -13,74 +19,303 @@ except Exception:
 
 PROCESSING_FRAME_SIZE = 4096
 SAMPLE_RATE = 16000
+AEC_FILTER_LENGTH = 1024
+INPUT_RING_SECONDS = 2.0
+# One of noise_suppression.NR_BACKENDS
+NR_BACKEND = os.getenv('NR_BACKEND', 'spectral_gate')
+# Align the far-end reference to its echo in the mic before the AEC
+AEC_DELAY_ESTIMATION = os.getenv('AEC_DELAY_ESTIMATION', '1') == '1'
+# Once aligned the filter only has to cover the room response, not the pipeline latency
+ALIGNED_AEC_FILTER_LENGTH = 512
+# The reference is aligned this many samples early so the echo onset stays inside the filter
+AEC_DELAY_MARGIN = 64
+
+LOW_LATENCY = os.getenv('AUDIO_LOW_LATENCY', '0') == '1'
+LOW_LATENCY_AEC_FRAME_SIZE = 256
+# NR call overhead is paid per block, so the NR runs once per output frame rather than per
+# AEC frame. An output frame is only emitted once complete, so this adds no latency.
+LOW_LATENCY_NR_BLOCK_SIZE = 1280
+LOW_LATENCY_OUTPUT_FRAME_SIZE = 1280
+
+# Processing levels, from full quality to the cheapest pipeline that still cancels echo
+PROCESSING_FULL = 0
+PROCESSING_REDUCED_NR = 1
+PROCESSING_NO_NR = 2
+PROCESSING_AEC_ONLY = 3
+PROCESSING_LEVEL_NAMES = ('full', 'reduced_nr', 'no_nr', 'aec_only')
+LOAD_SHEDDING = os.getenv('AUDIO_LOAD_SHEDDING', '1') == '1'
+# Processing time as a fraction of the audio duration. Above SHED_LOAD the next cheaper
+# level is used, and a level is only restored after the load stays below RESTORE_LOAD
+SHED_LOAD = 0.8
+RESTORE_LOAD = 0.4
+SHED_DWELL_S = 2.0
+RESTORE_DWELL_S = 10.0
+# NR input replayed into a newly selected stage, covers the longest NR latency with room for its noise estimate to settle
+NR_HISTORY_SAMPLES = 4096
+
+# Points on the capture path a listener can tap: the mic as submitted, the AEC output before
+# ducking and NR, or the final output
+TAP_RAW = 'raw'
+TAP_AEC = 'aec'
+TAP_PROCESSED = 'processed'
+TAP_STAGES = (TAP_RAW, TAP_AEC, TAP_PROCESSED)
+
+
+class FrameTap:
+  # Re-frames the audio from one tap into fixed size frames, keeping the stream position of each frame
+  def __init__(self, frame_size: int, listener: Callable[[bytes, int], None]) -> None:
+    self.frame_size = frame_size
+    self.listener = listener
+    self._buffer = b""
+    self._position = 0
+
+  def push(self, data: bytes, position: int) -> None:
+    if position != self._position + len(self._buffer) // 2:
+      # Input was dropped, start a new frame at the new position
+      self._buffer = b""
+      self._position = position
+    self._buffer += data
+    frame_bytes = self.frame_size * 2
+    while len(self._buffer) >= frame_bytes:
+      self.listener(self._buffer[:frame_bytes], self._position)
+      self._buffer = self._buffer[frame_bytes:]
+      self._position += self.frame_size
 
 
 class AudioProcessor:
-  def __init__(self, sample_rate: int = 16000) -> None:
-      self.aec: Optional[object] = EchoCanceller.create(PROCESSING_FRAME_SIZE, 1024, SAMPLE_RATE) if AEC_AVAILABLE else None
+  def __init__(self, sample_rate: int = 16000, low_latency: bool = LOW_LATENCY, overflow_policy: str = DROP_OLDEST, load_shedding: bool = LOAD_SHEDDING, threaded: bool = True, delay_estimation: bool = AEC_DELAY_ESTIMATION, nr_backend: str = NR_BACKEND) -> None:
+      if low_latency:
+        self.aec_frame_size = LOW_LATENCY_AEC_FRAME_SIZE
+        self.nr_block_size = LOW_LATENCY_NR_BLOCK_SIZE
+        self.output_frame_size = LOW_LATENCY_OUTPUT_FRAME_SIZE
+      else:
+        self.aec_frame_size = PROCESSING_FRAME_SIZE
+        self.nr_block_size = PROCESSING_FRAME_SIZE
+        self.output_frame_size = PROCESSING_FRAME_SIZE
+
+      self.delay_estimator: Optional[DelayEstimator] = DelayEstimator(SAMPLE_RATE) if delay_estimation else None
+      self.far_end_delay: Optional[DelayLine] = DelayLine(self.delay_estimator.max_delay, self.aec_frame_size) if delay_estimation else None
+      self.aec_filter_length = ALIGNED_AEC_FILTER_LENGTH if delay_estimation else AEC_FILTER_LENGTH
+      self.aec: Optional[object] = EchoCanceller.create(self.aec_frame_size, self.aec_filter_length, SAMPLE_RATE) if AEC_AVAILABLE else None
 
-      self.nr_previous_frame: np.ndarray = np.zeros(PROCESSING_FRAME_SIZE, dtype=np.int16)
-      self.aec_buffer = b""
-      self.speaker_buffer = b""
+      # Row 0 is the near-end (mic) signal, row 1 the far-end (speaker) reference
+      self._input_ring = RingBuffer(
+        int(INPUT_RING_SECONDS * SAMPLE_RATE),
+        channels=2,
+        max_read=self.aec_frame_size,
+        overflow_policy=overflow_policy,
+      )
+      self.ducker = CaptureDucker(sample_rate=SAMPLE_RATE)
+      self.nr_buffer = b""
+      self.output_buffer = b""
+
+      self._output_listeners: list[Callable[[bytes, int], None]] = []
+      self._output_position = 0
+      self._taps: dict[str, list[FrameTap]] = {TAP_RAW: [], TAP_AEC: []}
+      # Position of the next sample taken from the input ring, which excludes dropped input
+      self._input_position = 0
+
+      self.nr_backend = nr_backend
+      self.nr_processor: NoiseSuppressor = create_noise_suppressor(nr_backend, SAMPLE_RATE)
+      self.reduced_nr_processor: NoiseSuppressor = create_noise_suppressor(nr_backend, SAMPLE_RATE, reduced=True)
+      # Every level delays the output by the same amount so a level change never moves the
+      # stream, levels with a shorter NR latency (or no NR) make up the rest with a delay line
+      self.nr_latency = max(self.nr_processor.latency, self.reduced_nr_processor.latency)
+      self._nr_delay_line = bytes(2 * (self.nr_latency - self.nr_processor.latency))
+      self._nr_history = b""
+      self._nr_input_samples = 0
+      self._nr_output_samples = 0
+      self._nr_discard_samples = 0
+
+      self.load_shedding = load_shedding
+      self.processing_level = PROCESSING_FULL
+      self.load = 0.0
+      self._level_changed_at = time.monotonic()
+      self._headroom_since: Optional[float] = None
+      self._last_overflows = 0
+      self._level_changes = metrics.counter('processor.level_changes')
 
-      self._input_queue: queue.Queue[tuple[bytes, bytes]] = queue.Queue(maxsize=100)
-      self._output_queue: queue.Queue[bytes] = queue.Queue(maxsize=100)
+      self._aec_time = metrics.histogram('processor.aec_ms')
+      self._delay_estimation_time = metrics.histogram('processor.delay_estimation_ms')
+      self._ducking_time = metrics.histogram('processor.ducking_ms')
+      self._nr_time = metrics.histogram('processor.nr_ms')
 
+      # Without the thread the caller drives processing through process_pending(), e.g. offline benchmarks
       self._processing_thread = threading.Thread(target=self._process_loop, daemon=True)
-      self._processing_thread.start()
-
-      self.spectral_nr_processor: SpectralGateNonStationary = SpectralGateNonStationary(
-        y=np.zeros(1),
-        sr=SAMPLE_RATE,
-        chunk_size=PROCESSING_FRAME_SIZE,
-        padding=None,
-        n_fft=1024,
-        win_length=None,
-        hop_length=None,
-        time_constant_s=PROCESSING_FRAME_SIZE / float(SAMPLE_RATE),
-        freq_mask_smooth_hz=500,
-        time_mask_smooth_ms=64,
-        thresh_n_mult_nonstationary=4,
-        sigmoid_slope_nonstationary=20,
-        tmp_folder=None,
-        prop_decrease=0.7,
-        use_tqdm=False,
-        n_jobs=3,
-      )
+      if threaded:
+        self._processing_thread.start()
+
 
+  def _active_nr(self) -> Optional[NoiseSuppressor]:
+      if self.processing_level == PROCESSING_FULL:
+        return self.nr_processor
+      if self.processing_level == PROCESSING_REDUCED_NR:
+        return self.reduced_nr_processor
+      return None
 
   def _apply_streaming_nr(self, audio_int16: bytes) -> bytes:
-      audio_array = np.frombuffer(audio_int16, dtype=np.int16)
-      combined = np.concatenate([self.nr_previous_frame, audio_array])
-      reduced_2d = self.spectral_nr_processor.spectral_gating_nonstationary(combined.reshape(1, -1))
-      reduced = reduced_2d[0]
-      processed = reduced[PROCESSING_FRAME_SIZE:]
-      self.nr_previous_frame = audio_array.copy()
-      return processed.tobytes()
+      self._nr_history = (self._nr_history + audio_int16)[-NR_HISTORY_SAMPLES * 2:]
+      self._nr_input_samples += len(audio_int16) // 2
+      return self._run_nr(audio_int16)
+
+  def _run_nr(self, audio_int16: bytes) -> bytes:
+      nr = self._active_nr()
+      output = nr.process(np.frombuffer(audio_int16, dtype=np.int16)).tobytes() if nr else audio_int16
+      if self._nr_delay_line:
+        delayed = self._nr_delay_line + output
+        output, self._nr_delay_line = delayed[:len(output)], delayed[len(output):]
+      if self._nr_discard_samples:
+        discard = min(self._nr_discard_samples, len(output) // 2)
+        self._nr_discard_samples -= discard
+        output = output[discard * 2:]
+      self._nr_output_samples += len(output) // 2
+      return output
+
+  def _restart_nr(self) -> None:
+      # Brings a newly selected NR stage up to the stream position: the recent input is
+      # replayed through it and the output the stream already has is dropped, so nothing is
+      # lost or repeated at the switch
+      nr = self._active_nr()
+      if nr:
+        nr.reset()
+      self._nr_delay_line = bytes(2 * (self.nr_latency - (nr.latency if nr else 0)))
+      pending = self._nr_input_samples - self._nr_output_samples
+      self._nr_discard_samples = NR_HISTORY_SAMPLES - pending
+      self.output_buffer += self._run_nr(self._nr_history.rjust(NR_HISTORY_SAMPLES * 2, b'\0'))
+
+  def warm_up(self) -> None:
+      # Runs the NR stages once on silence so their first-call setup (FFT plans, lazily
+      # loaded scipy modules) happens at startup rather than on the first live frames
+      silence = np.zeros(self.nr_block_size, dtype=np.int16)
+      for nr in (self.nr_processor, self.reduced_nr_processor):
+        nr.process(silence)
+        nr.reset()
 
   def submit(self, mic_data: bytes, speaker_data: bytes) -> None:
-    self._input_queue.put_nowait((mic_data, speaker_data))
+    mic = np.frombuffer(mic_data, dtype=np.int16)
+    speaker = np.frombuffer(speaker_data, dtype=np.int16)
+    written = self._input_ring.write(mic, speaker)
+    if self._taps[TAP_RAW] and written:
+      # Only the samples the ring took are processed, and samples it dropped don't count
+      # towards positions. DROP_NEWEST refuses the end of the write and never skips anything
+      # written, otherwise the oldest samples make room (including the head of an oversized write).
+      length = min(len(mic), len(speaker))
+      if self._input_ring.overflow_policy == DROP_NEWEST:
+        mic = mic[:written]
+        position = self._input_ring.write_position - written
+      else:
+        mic = mic[length - written:length]
+        position = self._input_ring.write_position - written - self._input_ring.dropped_samples
+      for tap in self._taps[TAP_RAW]:
+        tap.push(mic.tobytes(), position)
 
-  def get_processed(self) -> Optional[bytes]:
-    try:
-      return self._output_queue.get_nowait()
-    except queue.Empty:
-      return None
+  def add_output_listener(self, listener: Callable[[bytes, int], None]) -> None:
+    self._output_listeners.append(listener)
+
+  def add_tap_listener(self, stage: str, frame_size: int, listener: Callable[[bytes, int], None]) -> None:
+    # Listeners get output stream positions: where the frame's audio will appear in the output.
+    # Raw taps are called from submit(), AEC taps from the processing thread, so listeners must not block.
+    if stage == TAP_PROCESSED:
+      self.add_output_listener(FrameTap(frame_size, listener).push)
+    elif stage in self._taps:
+      # The NR stage delays the output by nr_latency at every level, the other stages keep samples in place
+      self._taps[stage].append(FrameTap(frame_size, lambda frame, position: listener(frame, position + self.nr_latency)))
+    else:
+      raise ValueError(f'Unknown capture tap: {stage}')
 
   def _process_loop(self) -> None:
     while True:
-      mic_data, speaker_data = self._input_queue.get()
-      self.aec_buffer += mic_data
-      self.speaker_buffer += speaker_data
+      if self._input_ring.wait(self.aec_frame_size, timeout=1):
+        self.process_pending()
+
+  def process_pending(self) -> None:
+    pass_start = time.perf_counter()
+    processed_samples = 0
+    while (frame := self._input_ring.peek(self.aec_frame_size)) is not None:
+      mic_frame = frame[0].tobytes()
+      speaker_frame = self._align_far_end(frame[0], frame[1]).tobytes() if self.delay_estimator else frame[1].tobytes()
+      self._input_ring.consume(self.aec_frame_size)
+      processed_samples += self.aec_frame_size
+      start = time.perf_counter()
+      processed = self.aec.process(mic_frame, speaker_frame) if self.aec else mic_frame
+      self._aec_time.observe_since(start)
+      for tap in self._taps[TAP_AEC]:
+        tap.push(processed, self._input_position)
+      self._input_position += self.aec_frame_size
+      # Ducking follows the AEC so the canceller always sees the true microphone level
+      if self.processing_level < PROCESSING_AEC_ONLY:
+        start = time.perf_counter()
+        processed = self.ducker.process(np.frombuffer(processed, dtype=np.int16), np.frombuffer(speaker_frame, dtype=np.int16)).tobytes()
+        self._ducking_time.observe_since(start)
+      self.nr_buffer += processed
+
+    # Every whole block that has built up goes through the NR in one call
+    nr_bytes = len(self.nr_buffer) // (self.nr_block_size * 2) * self.nr_block_size * 2
+    if nr_bytes:
+      nr_block = self.nr_buffer[:nr_bytes]
+      self.nr_buffer = self.nr_buffer[nr_bytes:]
+      start = time.perf_counter()
+      self.output_buffer += self._apply_streaming_nr(nr_block)
+      self._nr_time.observe_since(start)
+
+    output_frame_bytes = self.output_frame_size * 2
+    while len(self.output_buffer) >= output_frame_bytes:
+      self._emit_output(self.output_buffer[:output_frame_bytes])
+      self.output_buffer = self.output_buffer[output_frame_bytes:]
+
+    if self.load_shedding and processed_samples:
+      self._update_processing_level(time.perf_counter() - pass_start, processed_samples)
+
+  def _align_far_end(self, mic: np.ndarray, far_end: np.ndarray) -> np.ndarray:
+    start = time.perf_counter()
+    delay = self.delay_estimator.process(mic, far_end)
+    self._delay_estimation_time.observe_since(start)
+    if delay is not None:
+      self.far_end_delay.delay = max(0, delay - AEC_DELAY_MARGIN)
+    return self.far_end_delay.process(far_end)
+
+  def _update_processing_level(self, elapsed_s: float, processed_samples: int) -> None:
+    self.load += (elapsed_s * SAMPLE_RATE / processed_samples - self.load) * 0.2
+    overflows = self._input_ring.overflows
+    overflowed = overflows != self._last_overflows
+    self._last_overflows = overflows
+    now = time.monotonic()
+
+    if self.load > RESTORE_LOAD or overflowed:
+      self._headroom_since = None
+    elif self._headroom_since is None:
+      self._headroom_since = now
+
+    if (self.load > SHED_LOAD or overflowed) and self.processing_level < PROCESSING_AEC_ONLY:
+      if now - self._level_changed_at >= SHED_DWELL_S or overflowed:
+        self._set_processing_level(self.processing_level + 1)
+    elif self._headroom_since is not None and self.processing_level > PROCESSING_FULL:
+      if now - max(self._headroom_since, self._level_changed_at) >= RESTORE_DWELL_S:
+        self._set_processing_level(self.processing_level - 1)
 
-      if len(self.aec_buffer) < PROCESSING_FRAME_SIZE * 2:
-        continue
+  def _set_processing_level(self, level: int) -> None:
+    logging.info(f'Audio processing level {PROCESSING_LEVEL_NAMES[self.processing_level]} -> {PROCESSING_LEVEL_NAMES[level]} (load {self.load:.2f})')
+    previous_nr = self._active_nr()
+    self.processing_level = level
+    self._level_changed_at = time.monotonic()
+    self._headroom_since = None
+    self._level_changes.inc()
+    if self._active_nr() is not previous_nr:
+      self._restart_nr()
 
-      frame_bytes = self.aec_buffer[: PROCESSING_FRAME_SIZE * 2]
-      self.aec_buffer = self.aec_buffer[PROCESSING_FRAME_SIZE * 2 :]
-      speaker_frame = self.speaker_buffer[: PROCESSING_FRAME_SIZE * 2]
-      self.speaker_buffer = self.speaker_buffer[PROCESSING_FRAME_SIZE * 2 :]
+  def _emit_output(self, frame: bytes) -> None:
+    # Listeners also get the absolute sample position of the frame in the output stream
+    for listener in self._output_listeners:
+      listener(frame, self._output_position)
+    self._output_position += len(frame) // 2
 
-      aec_out = self.aec.process(frame_bytes, speaker_frame) if self.aec else frame_bytes
-      nr_out = self._apply_streaming_nr(aec_out)
-      self._output_queue.put_nowait(nr_out)
+  def get_stats(self) -> dict[str, float]:
+    return {
+      **self._input_ring.get_stats(),
+      'processing_level': self.processing_level,
+      'load': self.load,
+      **{f'ducking_{key}': value for key, value in self.ducker.get_stats().items()},
+      **({f'echo_{key}': value for key, value in self.delay_estimator.get_stats().items()} if self.delay_estimator else {}),
+      'aec_filter_length': self.aec_filter_length,
+      'aec_reference_delay_ms': (self.far_end_delay.delay if self.far_end_delay else 0) * 1000 / SAMPLE_RATE,
+    }
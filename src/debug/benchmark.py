@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import uuid
+import numpy as np
+from typing import Callable, Dict, Optional
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SRC_DIR)
+
+SAMPLE_RATE = 16000
+CALLBACK_SIZE = 1024
+SERVER_SAMPLE_RATE = 24000
+SERVER_CHUNK_SIZE = 960
+WAKEWORD_FRAME_SIZE = 1280
+UPLINK_PACKET_SIZE = 1280
+# Only these results are compared against a baseline, lower is better for all of them
+COMPARED_RESULTS = ('rtf', 'p95_ms', 'peak_memory_kb')
+
+
+def generate_fixture(seconds: float, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+  # Deterministic stand-in for a recording: a far end of amplitude modulated harmonics, and a
+  # mic picking up a delayed, filtered copy of it plus bursts of near-end "speech" and noise
+  rng = np.random.default_rng(seed)
+  t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+  envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 3 * t)
+  far_end = sum(np.sin(2 * np.pi * f * t) / (i + 1) for i, f in enumerate((180, 360, 540, 720)))
+  far_end = 6000 * envelope * far_end / 2
+  echo = np.convolve(far_end, np.exp(-np.arange(400) / 80) / 40, mode='full')[:len(t)]
+  echo = np.concatenate([np.zeros(160), echo[:-160]])
+  near_end = np.sin(2 * np.pi * 220 * t + 3 * np.sin(2 * np.pi * 5 * t)) * 5000 * (np.sin(2 * np.pi * 0.25 * t) > 0.3)
+  mic = echo + near_end + rng.normal(0, 300, len(t))
+  return np.clip(mic, -32768, 32767).astype(np.int16), np.clip(far_end, -32768, 32767).astype(np.int16)
+
+
+def load_fixture(path: str, far_end_path: Optional[str], seconds: float) -> tuple[np.ndarray, np.ndarray]:
+  from scipy.io import wavfile
+  _, mic = wavfile.read(path)
+  if far_end_path:
+    _, far_end = wavfile.read(far_end_path)
+  else:
+    far_end = np.zeros(len(mic), dtype=np.int16)
+  far_end = np.pad(far_end, (0, max(0, len(mic) - len(far_end))))[:len(mic)]
+  n_samples = min(len(mic), int(seconds * SAMPLE_RATE)) if seconds else len(mic)
+  return mic[:n_samples].astype(np.int16), far_end[:n_samples].astype(np.int16)
+
+
+def summarize(frame_times_s: list[float], audio_s: float) -> Dict[str, float]:
+  frame_ms = np.array(frame_times_s) * 1000
+  return {
+    'rtf': float(np.sum(frame_times_s) / audio_s),
+    'frames': len(frame_ms),
+    'p50_ms': float(np.percentile(frame_ms, 50)),
+    'p95_ms': float(np.percentile(frame_ms, 95)),
+    'p99_ms': float(np.percentile(frame_ms, 99)),
+    'max_ms': float(np.max(frame_ms)),
+  }
+
+
+def measure(run: Callable[[], tuple[list[float], float]]) -> Dict[str, float]:
+  # Timing and memory come from separate passes so tracemalloc does not skew the timings
+  frame_times_s, audio_s = run()
+  result = summarize(frame_times_s, audio_s)
+  tracemalloc.start()
+  run()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  result['peak_memory_kb'] = peak / 1024
+  return result
+
+
+def bench_processor(mic: np.ndarray, far_end: np.ndarray, low_latency: bool, nr_backend: str) -> Dict[str, float]:
+  from audioprocessor import AudioProcessor
+
+  def run() -> tuple[list[float], float]:
+    processor = AudioProcessor(sample_rate=SAMPLE_RATE, low_latency=low_latency, load_shedding=False, threaded=False, nr_backend=nr_backend)
+    frame_times_s = []
+    for i in range(0, len(mic) - CALLBACK_SIZE + 1, CALLBACK_SIZE):
+      mic_bytes = mic[i:i + CALLBACK_SIZE].tobytes()
+      far_bytes = far_end[i:i + CALLBACK_SIZE].tobytes()
+      start = time.perf_counter()
+      processor.submit(mic_bytes, far_bytes)
+      processor.process_pending()
+      frame_times_s.append(time.perf_counter() - start)
+    return frame_times_s, len(mic) / SAMPLE_RATE
+
+  return measure(run)
+
+
+def bench_playout(seconds: float) -> Dict[str, float]:
+  from audio import AudioFrameBuffer
+  server_audio = generate_fixture(seconds * SERVER_SAMPLE_RATE / SAMPLE_RATE, seed=1)[1]
+
+  def run() -> tuple[list[float], float]:
+    buffer = AudioFrameBuffer(CALLBACK_SIZE, 2, SAMPLE_RATE)
+    frame_times_s = []
+    for i in range(0, len(server_audio) - SERVER_CHUNK_SIZE + 1, SERVER_CHUNK_SIZE):
+      chunk = server_audio[i:i + SERVER_CHUNK_SIZE].tobytes()
+      start = time.perf_counter()
+      buffer.write_24khz_data(chunk)
+      while buffer.fill_level() * SAMPLE_RATE >= CALLBACK_SIZE:
+        buffer.get_frame()
+      frame_times_s.append(time.perf_counter() - start)
+    return frame_times_s, len(server_audio) / SERVER_SAMPLE_RATE
+
+  return measure(run)
+
+
+def bench_wakeword(mic: np.ndarray) -> Dict[str, float]:
+  from wakeword_detector import WakeWordDetector
+  # The model files live in the repository root, where main.py is run from
+  cwd = os.getcwd()
+  os.chdir(os.path.join(SRC_DIR, '..'))
+  try:
+    detector = WakeWordDetector()
+  finally:
+    os.chdir(cwd)
+
+  def run() -> tuple[list[float], float]:
+    detector.reset()
+    frame_times_s = []
+    for i in range(0, len(mic) - WAKEWORD_FRAME_SIZE + 1, WAKEWORD_FRAME_SIZE):
+      frame = mic[i:i + WAKEWORD_FRAME_SIZE].tobytes()
+      start = time.perf_counter()
+      detector.detect(frame, i + WAKEWORD_FRAME_SIZE)
+      frame_times_s.append(time.perf_counter() - start)
+    return frame_times_s, len(mic) / SAMPLE_RATE
+
+  return measure(run)
+
+
+class NullMqtt:
+  # Publishing sink so only the request encoding in Homenode is measured
+  def set_publish_policy(self, topic: str, priority: int, ttl_s: Optional[float] = None) -> None:
+    pass
+
+  async def publish(self, topic: str, payload: object, retain: bool = False, wait: bool = True) -> None:
+    pass
+
+
+def bench_uplink(mic: np.ndarray, codec_name: str) -> Dict[str, float]:
+  import homenode
+  from audio_codecs import get_codec
+
+  async def send_all() -> list[float]:
+    node = homenode.Homenode(NullMqtt())
+    node._uplink_codec = get_codec(codec_name) if codec_name != 'json' else None
+    node._session_uuid = uuid.UUID(int=0)
+    node._session_id = f'live_{node._session_uuid}'
+    frame_times_s = []
+    for i in range(0, len(mic) - UPLINK_PACKET_SIZE + 1, UPLINK_PACKET_SIZE):
+      packet = mic[i:i + UPLINK_PACKET_SIZE].tobytes()
+      start = time.perf_counter()
+      await node.send_audio(packet, time.time())
+      frame_times_s.append(time.perf_counter() - start)
+    return frame_times_s
+
+  def run() -> tuple[list[float], float]:
+    return asyncio.run(send_all()), len(mic) / SAMPLE_RATE
+
+  return measure(run)
+
+
+def run_benchmarks(args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+  if args.fixture:
+    mic, far_end = load_fixture(args.fixture, args.far_end, args.seconds)
+  else:
+    mic, far_end = generate_fixture(args.seconds)
+
+  benchmarks: Dict[str, Callable[[], Dict[str, float]]] = {
+    'processor': lambda: bench_processor(mic, far_end, args.low_latency, args.nr_backend),
+    'playout_24khz': lambda: bench_playout(len(mic) / SAMPLE_RATE),
+    'wakeword_detect': lambda: bench_wakeword(mic),
+  }
+  for codec_name in ('json', 'pcm', 'mulaw', 'ima_adpcm'):
+    benchmarks[f'uplink_{codec_name}'] = lambda codec_name=codec_name: bench_uplink(mic, codec_name)
+
+  results: Dict[str, Dict[str, float]] = {}
+  for name, bench in benchmarks.items():
+    if args.only and name not in args.only:
+      continue
+    try:
+      results[name] = bench()
+    except ImportError as e:
+      results[name] = {'skipped': str(e)}
+    print(f'{name}: {results[name]}', file=sys.stderr)
+  return results
+
+
+def find_regressions(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> list[str]:
+  regressions = []
+  for name, result in results.items():
+    for key in COMPARED_RESULTS:
+      if key not in result or key not in baseline.get(name, {}):
+        continue
+      limit = baseline[name][key] * (1 + tolerance)
+      if result[key] > limit:
+        regressions.append(f'{name}.{key}: {result[key]:.6g} > {limit:.6g} (baseline {baseline[name][key]:.6g})')
+  return regressions
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description='Benchmark the DSP, playout, wake word and uplink hot paths')
+  parser.add_argument('--fixture', help='16kHz mono WAV to use as mic input instead of the generated fixture')
+  parser.add_argument('--far-end', help='16kHz mono WAV to use as the far-end reference for --fixture')
+  parser.add_argument('--seconds', type=float, default=30.0, help='Length of the generated fixture, or cap on --fixture')
+  parser.add_argument('--low-latency', action='store_true', help='Benchmark the processor in low latency mode')
+  parser.add_argument('--nr-backend', default='spectral_gate', help='Noise suppression backend for the processor benchmark')
+  parser.add_argument('--only', nargs='*', help='Only run these benchmarks')
+  parser.add_argument('--output', help='Write the JSON report here as well as stdout')
+  parser.add_argument('--baseline', help='JSON report to compare against, exits non-zero on regressions')
+  parser.add_argument('--tolerance', type=float, default=0.15, help='Allowed fractional regression against the baseline')
+  args = parser.parse_args()
+
+  report = {
+    'machine': {'platform': platform.platform(), 'processor': platform.machine(), 'python': platform.python_version()},
+    'settings': {'seconds': args.seconds, 'fixture': args.fixture or 'generated', 'low_latency': args.low_latency, 'nr_backend': args.nr_backend},
+    'results': run_benchmarks(args),
+  }
+  output = json.dumps(report, indent=2)
+  print(output)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(output + '\n')
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = find_regressions(report['results'], baseline['results'], args.tolerance)
+    for regression in regressions:
+      print(f'REGRESSION {regression}', file=sys.stderr)
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
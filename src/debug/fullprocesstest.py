@@ -4,7 +4,6 @@ import sys
 sys.path.insert(0, '..')
 from audioprocessor import AudioProcessor
 
-FRAME_SIZE = 4096
 SAMPLE_RATE = 16000
 
 rate, data = wavfile.read('testraw.wav')
@@ -16,8 +15,10 @@ if len(far_end_data) < len(data):
 else:
     far_end_data = far_end_data[:len(data)]
 
-# Create processor
-processor = AudioProcessor(frame_size=FRAME_SIZE, sample_rate=SAMPLE_RATE)
+# Create processor, processing is driven from this script so no input is dropped
+processor = AudioProcessor(sample_rate=SAMPLE_RATE, load_shedding=False, threaded=False)
+processed_frames = []
+processor.add_output_listener(lambda frame, _position: processed_frames.append(frame))
 
 # Process audio in 1024-byte chunks (simulating real-time callback)
 CALLBACK_SIZE = 1024
@@ -36,14 +37,10 @@ for i in range(0, len(data), CALLBACK_SIZE):
 
     # Submit to processor
     processor.submit(mic_bytes, far_bytes)
+    processor.process_pending()
 
 # Collect all processed output
-processed = b''
-while True:
-    result = processor.get_processed()
-    if result is None:
-        break
-    processed += result
+processed = b''.join(processed_frames)
 
 # Convert to array
 processed_array = np.frombuffer(processed, dtype=np.int16)
@@ -0,0 +1,94 @@
+import logging
+import numpy as np
+from typing import Optional
+from ringbuffer import RingBuffer, OVERWRITE
+
+
+class DelayEstimator:
+  # Tracks the bulk delay from the far-end reference to its echo in the mic with GCC-PHAT
+  # (phase transform weighted FFT cross-correlation), which gives a sharp peak even for
+  # tonal or coloured playback. An estimate is only taken while the far end is playing and
+  # the delay only moves once two consecutive confident estimates agree.
+  def __init__(
+    self,
+    sample_rate: int = 16000,
+    max_delay_ms: float = 250.0,
+    window_s: float = 1.0,
+    update_interval_s: float = 0.5,
+    min_far_end_db: float = -45.0,
+    min_peak_ratio: float = 6.0,
+    tolerance_ms: float = 2.0,
+  ) -> None:
+    self.sample_rate = sample_rate
+    self.max_delay = int(max_delay_ms * sample_rate / 1000)
+    self.window = int(window_s * sample_rate)
+    self.update_interval = int(update_interval_s * sample_rate)
+    self.min_far_end_db = min_far_end_db
+    self.min_peak_ratio = min_peak_ratio
+    self.tolerance = int(tolerance_ms * sample_rate / 1000)
+    self._n_fft = 1 << int(np.ceil(np.log2(self.window + self.max_delay)))
+    self._history = RingBuffer(self.window + self.max_delay, channels=2, overflow_policy=OVERWRITE)
+    self._samples_since_update = 0
+    self._candidate: Optional[int] = None
+
+    self.delay_samples: Optional[int] = None
+    self.confidence = 0.0
+    self.estimates = 0
+    self.delay_changes = 0
+
+  def process(self, mic: np.ndarray, far_end: np.ndarray) -> Optional[int]:
+    self._history.write(mic, far_end)
+    self._samples_since_update += len(mic)
+    if self._samples_since_update >= self.update_interval and self._history.write_position >= self.window + self.max_delay:
+      self._samples_since_update = 0
+      self._update()
+    return self.delay_samples
+
+  def _update(self) -> None:
+    _, history = self._history.read_history(self._history.write_position - self.window - self.max_delay, self.window + self.max_delay)
+    mic = history[0].astype(np.float32)
+    # The far-end window ends max_delay before the mic window, so every candidate lag sees a full window
+    far_end = history[1, :self.window].astype(np.float32)
+    if 10 * np.log10(np.mean((far_end / 32768.0) ** 2) + 1e-12) < self.min_far_end_db:
+      return
+
+    cross = np.fft.rfft(mic, self._n_fft) * np.conj(np.fft.rfft(far_end, self._n_fft))
+    correlation = np.fft.irfft(cross / (np.abs(cross) + 1e-9), self._n_fft)[:self.max_delay + 1]
+    peak = int(np.argmax(correlation))
+    self.confidence = float(correlation[peak] / (np.mean(np.abs(correlation)) + 1e-9))
+    self.estimates += 1
+    if self.confidence < self.min_peak_ratio:
+      return
+
+    if self._candidate is None or abs(peak - self._candidate) > self.tolerance:
+      self._candidate = peak
+      return
+    if self.delay_samples is None or abs(peak - self.delay_samples) > self.tolerance:
+      logging.info(f'Echo delay estimate {self.delay_samples} -> {peak} samples (confidence {self.confidence:.1f})')
+      self.delay_samples = peak
+      self.delay_changes += 1
+
+  def get_stats(self) -> dict[str, float]:
+    return {
+      'delay_ms': (self.delay_samples or 0) * 1000 / self.sample_rate,
+      'confidence': self.confidence,
+      'estimates': self.estimates,
+      'delay_changes': self.delay_changes,
+    }
+
+
+class DelayLine:
+  # Delays a signal by a number of samples that can change between blocks
+  def __init__(self, max_delay: int, max_block: int) -> None:
+    self.max_delay = max_delay
+    self.delay = 0
+    self._ring = RingBuffer(max_delay + max_block, overflow_policy=OVERWRITE)
+
+  def process(self, samples: np.ndarray) -> np.ndarray:
+    self._ring.write(samples)
+    requested = self._ring.write_position - len(samples) - self.delay
+    start, delayed = self._ring.read_history(requested, len(samples))
+    if start != requested or len(delayed) < len(samples):
+      # Nothing was written that far back yet
+      delayed = np.concatenate([np.zeros(start - requested, dtype=np.int16), delayed])[:len(samples)]
+    return delayed
@@ -0,0 +1,195 @@
+import base64
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, NamedTuple, Optional
+from metrics import metrics
+
+SAMPLE_RATE = 16000
+# Audio held back at the start of each turn so jitter in the downlink doesn't cause underruns
+DOWNLINK_START_MS = int(os.getenv('DOWNLINK_START_MS', '120'))
+# Undecoded events waiting for the decode thread, the oldest are dropped beyond this
+DOWNLINK_QUEUE_EVENTS = 256
+
+
+class DownlinkChunk(NamedTuple):
+  turn: int
+  # None marks the end of the turn
+  audio_base64: Optional[str]
+  sample_rate: int
+  received_time: float
+
+
+class DownlinkPlayer:
+  # Decodes downlink audio events on a worker thread and writes them to the playout buffer,
+  # so bursts of model audio never base64 decode or resample on the event loop. Each turn is
+  # held back until start_ms of audio is buffered, the turn ends or the downlink stalls, then
+  # streams straight through. Turns are numbered and interrupt() drops everything queued or
+  # held for the turns before it, including a chunk the worker is decoding at the time.
+  def __init__(
+    self,
+    write: Callable[[bytes, int], None],
+    stop: Callable[[], None],
+    playout_level: Callable[[], float],
+    start_ms: int = DOWNLINK_START_MS,
+  ) -> None:
+    self._write = write
+    self._stop = stop
+    self._playout_level = playout_level
+    self.start_samples = SAMPLE_RATE * start_ms // 1000
+    self._chunks: queue.Queue[DownlinkChunk] = queue.Queue(maxsize=DOWNLINK_QUEUE_EVENTS)
+    self._lock = threading.Lock()
+    # Next turn number on the event loop side, and the first turn that hasn't been interrupted
+    self._turn = 0
+    self._live_turn = 0
+
+    # State of the turn the worker is playing, guarded by _lock
+    self._active_turn: Optional[int] = None
+    self._held: Optional[list[tuple[bytes, int]]] = None
+    self._held_samples = 0
+    self._turn_received_time = 0.0
+    self._turn_first_audio_s: Optional[float] = None
+    self._turn_samples = 0
+    self._turn_max_buffered_s = 0.0
+
+    self.turns = 0
+    self.interrupted_turns = 0
+    self.dropped_chunks = 0
+    self.last_first_audio_s = 0.0
+    self._decode_time = metrics.histogram('downlink.decode_ms')
+    self._write_time = metrics.histogram('downlink.write_ms')
+    self._first_audio_time = metrics.histogram('downlink.first_audio_ms')
+
+    self._worker = threading.Thread(target=self._decode_loop, daemon=True)
+    self._worker.start()
+
+  def push(self, audio_base64: str, sample_rate: int) -> None:
+    self._enqueue(DownlinkChunk(self._turn, audio_base64, sample_rate, time.monotonic()))
+
+  def end_turn(self) -> None:
+    # Plays out anything still held for the turn, later audio starts the next turn
+    self._enqueue(DownlinkChunk(self._turn, None, 0, time.monotonic()))
+    self._turn += 1
+
+  def interrupt(self) -> None:
+    with self._lock:
+      self._turn += 1
+      self._live_turn = self._turn
+      while True:
+        try:
+          self._chunks.get_nowait()
+        except queue.Empty:
+          break
+      if self._active_turn is not None:
+        self.interrupted_turns += 1
+        self._held = None
+        self._finish_turn('interrupted')
+      self._stop()
+
+  def _enqueue(self, chunk: DownlinkChunk) -> None:
+    while True:
+      try:
+        self._chunks.put_nowait(chunk)
+        return
+      except queue.Full:
+        try:
+          self._chunks.get_nowait()
+          self.dropped_chunks += 1
+        except queue.Empty:
+          pass
+
+  def _decode_loop(self) -> None:
+    while True:
+      # Only a turn being held back has to wake up on a stall, otherwise just wait for audio.
+      # _held is only filled by this thread, so it can't go from empty to held while waiting.
+      timeout = self.start_samples / SAMPLE_RATE if self._held else None
+      try:
+        chunk = self._chunks.get(timeout=timeout)
+      except queue.Empty:
+        # The downlink stalled, play whatever the turn has rather than wait for more
+        with self._lock:
+          if self._held:
+            self._release_held()
+        continue
+
+      if chunk.audio_base64 is None:
+        with self._lock:
+          if chunk.turn == self._active_turn:
+            self._finish_turn('complete')
+        continue
+
+      start = time.perf_counter()
+      try:
+        data = base64.b64decode(chunk.audio_base64)
+      except ValueError as e:
+        logging.error(f'Failed to decode downlink audio: {e}')
+        continue
+      self._decode_time.observe_since(start)
+
+      with self._lock:
+        if chunk.turn < self._live_turn:
+          continue
+        if chunk.turn != self._active_turn:
+          self._begin_turn(chunk)
+        self._turn_samples += len(data) // 2 * SAMPLE_RATE // chunk.sample_rate
+        if self._held is None:
+          self._play(data, chunk.sample_rate)
+          continue
+        self._held.append((data, chunk.sample_rate))
+        self._held_samples += len(data) // 2 * SAMPLE_RATE // chunk.sample_rate
+        if self._held_samples >= self.start_samples:
+          self._release_held()
+
+  def _begin_turn(self, chunk: DownlinkChunk) -> None:
+    if self._active_turn is not None:
+      self._finish_turn('complete')
+    self._active_turn = chunk.turn
+    self._held = []
+    self._held_samples = 0
+    self._turn_received_time = chunk.received_time
+    self._turn_first_audio_s = None
+    self._turn_samples = 0
+    self._turn_max_buffered_s = 0.0
+
+  def _release_held(self) -> None:
+    held, self._held = self._held, None
+    self.last_first_audio_s = self._turn_first_audio_s = time.monotonic() - self._turn_received_time
+    self._first_audio_time.observe(self.last_first_audio_s * 1000)
+    for data, sample_rate in held:
+      self._play(data, sample_rate)
+
+  def _play(self, data: bytes, sample_rate: int) -> None:
+    start = time.perf_counter()
+    try:
+      self._write(data, sample_rate)
+    except Exception as e:
+      # e.g. the audio engine restarting, losing the chunk beats losing the worker thread
+      logging.error(f'Failed to write downlink audio: {e}')
+      return
+    self._write_time.observe_since(start)
+    self._turn_max_buffered_s = max(self._turn_max_buffered_s, self._playout_level())
+
+  def _finish_turn(self, outcome: str) -> None:
+    if self._held:
+      self._release_held()
+    self.turns += 1
+    first_audio = f'first audio after {self._turn_first_audio_s * 1000:.0f}ms' if self._turn_first_audio_s is not None else 'nothing played'
+    logging.info(
+      f'Downlink turn {self._active_turn} {outcome}: {first_audio}, '
+      f'{self._turn_samples / SAMPLE_RATE:.1f}s of audio, up to {self._turn_max_buffered_s:.1f}s buffered'
+    )
+    self._active_turn = None
+    self._held = None
+
+  def get_stats(self) -> dict[str, float]:
+    return {
+      'queued_events': self._chunks.qsize(),
+      'held_s': self._held_samples / SAMPLE_RATE if self._held is not None else 0.0,
+      'buffered_s': self._playout_level(),
+      'turns': self.turns,
+      'interrupted_turns': self.interrupted_turns,
+      'dropped_chunks': self.dropped_chunks,
+      'last_first_audio_ms': self.last_first_audio_s * 1000,
+    }
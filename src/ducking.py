@@ -0,0 +1,162 @@
+import logging
+import os
+import subprocess
+import threading
+import numpy as np
+from typing import Callable, Optional
+
+SUBFRAME_SIZE = 160
+CAPTURE_DUCK_DB = float(os.getenv('CAPTURE_DUCK_DB', '-7'))
+FAR_END_THRESHOLD_DB = -50.0
+
+
+class CaptureDucker:
+  # Lowers the capture gain while the speaker is playing. Far-end activity is measured per
+  # 10ms subframe of the exact speaker frames that were played against the capture, and the
+  # gain moves towards its target along a per-sample linear ramp so there are no steps.
+  # Ducking holds for a while after the far end goes quiet to avoid pumping between words.
+  def __init__(
+    self,
+    sample_rate: int = 16000,
+    duck_db: float = CAPTURE_DUCK_DB,
+    threshold_db: float = FAR_END_THRESHOLD_DB,
+    attack_ms: float = 20.0,
+    release_ms: float = 150.0,
+    hold_ms: float = 300.0,
+  ) -> None:
+    self.sample_rate = sample_rate
+    self.duck_db = duck_db
+    self.threshold_db = threshold_db
+    self.attack_ms = attack_ms
+    self.release_ms = release_ms
+    self.hold_ms = hold_ms
+    self._duck_gain = 10 ** (duck_db / 20)
+    # Gain change per sample for a full swing between unity and the ducked gain
+    self._attack_step = (1 - self._duck_gain) / max(1.0, attack_ms * sample_rate / 1000)
+    self._release_step = (1 - self._duck_gain) / max(1.0, release_ms * sample_rate / 1000)
+    self._hold_samples = int(hold_ms * sample_rate / 1000)
+    self._listeners: list[Callable[[bool], None]] = []
+
+    self.gain = 1.0
+    self.is_ducked = False
+    self._quiet_samples = 0
+    self.duck_count = 0
+    self.ducked_samples = 0
+    self.total_samples = 0
+    self.last_ramp_samples = 0
+    self._ramp_samples = 0
+
+  def add_listener(self, listener: Callable[[bool], None]) -> None:
+    self._listeners.append(listener)
+
+  def reset(self) -> None:
+    self.gain = 1.0
+    self._set_ducked(False)
+    self._quiet_samples = 0
+    self._ramp_samples = 0
+
+  def process(self, near_end: np.ndarray, far_end: np.ndarray) -> np.ndarray:
+    output = near_end.astype(np.float32)
+    for start in range(0, len(output), SUBFRAME_SIZE):
+      end = min(start + SUBFRAME_SIZE, len(output))
+      far = far_end[start:end].astype(np.float32) / 32768.0
+      level_db = 10 * np.log10(np.mean(far ** 2) + 1e-12) if len(far) else -120.0
+      self._update_state(level_db > self.threshold_db, end - start)
+      output[start:end] *= self._ramp(end - start)
+
+    self.total_samples += len(output)
+    if self.is_ducked:
+      self.ducked_samples += len(output)
+    return np.clip(output, -32768, 32767).astype(np.int16)
+
+  def _update_state(self, far_end_active: bool, n_samples: int) -> None:
+    if far_end_active:
+      self._quiet_samples = 0
+      self._set_ducked(True)
+    elif self.is_ducked:
+      self._quiet_samples += n_samples
+      if self._quiet_samples >= self._hold_samples:
+        self._set_ducked(False)
+
+  def _set_ducked(self, ducked: bool) -> None:
+    if ducked == self.is_ducked:
+      return
+    self.is_ducked = ducked
+    self._ramp_samples = 0
+    if ducked:
+      self.duck_count += 1
+    for listener in self._listeners:
+      listener(ducked)
+
+  def _ramp(self, n_samples: int) -> np.ndarray:
+    target = self._duck_gain if self.is_ducked else 1.0
+    if self.gain == target:
+      return np.full(n_samples, self.gain, dtype=np.float32)
+    step = -self._attack_step if target < self.gain else self._release_step
+    gains = self.gain + step * np.arange(1, n_samples + 1, dtype=np.float32)
+    gains = np.maximum(gains, target) if step < 0 else np.minimum(gains, target)
+    reached = np.flatnonzero(gains == target)
+    self.gain = float(gains[-1])
+    if len(reached):
+      self.last_ramp_samples = self._ramp_samples + int(reached[0]) + 1
+    self._ramp_samples += n_samples
+    return gains
+
+  def get_stats(self) -> dict[str, float]:
+    return {
+      'ducked': int(self.is_ducked),
+      'gain_db': 20 * np.log10(self.gain),
+      'duck_db': self.duck_db,
+      'attack_ms': self.attack_ms,
+      'release_ms': self.release_ms,
+      'hold_ms': self.hold_ms,
+      'last_ramp_ms': self.last_ramp_samples * 1000 / self.sample_rate,
+      'duck_count': self.duck_count,
+      'ducked_fraction': self.ducked_samples / self.total_samples if self.total_samples else 0.0,
+    }
+
+
+class HardwareMixer:
+  # Sets an ALSA mixer control from its own thread through one long-running `amixer -s`
+  # process, so changes never fork from the audio path. Only the latest request is applied.
+  def __init__(self, control: str = 'Capture', card: int = 0) -> None:
+    self.control = control
+    self.card = card
+    self._process: Optional[subprocess.Popen] = None
+    self._requested: Optional[int] = None
+    self._applied: Optional[int] = None
+    self._changed = threading.Condition()
+    self._thread = threading.Thread(target=self._mixer_loop, daemon=True)
+    self._thread.start()
+
+  def set_volume(self, percent: int) -> None:
+    with self._changed:
+      self._requested = percent
+      self._changed.notify()
+
+  def _mixer_loop(self) -> None:
+    while True:
+      with self._changed:
+        while self._requested == self._applied:
+          self._changed.wait()
+        percent = self._requested
+      try:
+        self._write(f'set {self.control} {percent}%\n')
+        self._applied = percent
+        logging.info(f'Set {self.control} volume to {percent}%')
+      except (OSError, ValueError) as e:
+        logging.error(f'Failed to set {self.control} volume: {e}')
+        self._process = None
+        self._applied = percent
+
+  def _write(self, command: str) -> None:
+    if not self._process or self._process.poll() is not None:
+      self._process = subprocess.Popen(
+        ['amixer', '-c', str(self.card), '-s'],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        text=True,
+      )
+    self._process.stdin.write(command)
+    self._process.stdin.flush()
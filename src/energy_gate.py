@@ -0,0 +1,76 @@
+import numpy as np
+from typing import Optional
+
+SUBFRAME_SIZE = 160
+MIN_NOISE_FLOOR_DB = -90.0
+ZCR_SPEECH_RANGE = (0.02, 0.35)
+
+
+class EnergyGate:
+  # Cheap speech/silence decision used to skip wake word inference in an empty room.
+  # Each frame is split into 10ms subframes and compared against an adaptive noise floor
+  # which falls quickly and rises slowly. Subframes that are only slightly above the floor
+  # also need a speech-like zero crossing rate. The gate stays open for a hangover period.
+  def __init__(
+    self,
+    sample_rate: int = 16000,
+    open_margin_db: float = 9.0,
+    noise_rise_db_per_s: float = 3.0,
+    hangover_s: float = 1.0,
+  ) -> None:
+    self.sample_rate = sample_rate
+    self.open_margin_db = open_margin_db
+    self.noise_rise_db_per_s = noise_rise_db_per_s
+    self.hangover_s = hangover_s
+    self.noise_floor_db: Optional[float] = None
+    self.is_open = False
+    self._hangover_remaining_s = 0.0
+    self.open_frames = 0
+    self.closed_frames = 0
+
+  def process(self, samples: np.ndarray) -> bool:
+    frame_s = len(samples) / self.sample_rate
+    n_subframes = max(1, len(samples) // SUBFRAME_SIZE)
+    subframes = samples[:n_subframes * SUBFRAME_SIZE].reshape(n_subframes, -1).astype(np.float32) / 32768.0
+
+    level_db = 10 * np.log10(np.mean(subframes ** 2, axis=1) + 1e-12)
+    signs = np.signbit(subframes)
+    zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+
+    quietest_db = float(np.min(level_db))
+    if self.noise_floor_db is None:
+      self.noise_floor_db = max(MIN_NOISE_FLOOR_DB, quietest_db)
+
+    above_floor = level_db - self.noise_floor_db
+    speech_like = (zcr > ZCR_SPEECH_RANGE[0]) & (zcr < ZCR_SPEECH_RANGE[1])
+    active = np.any((above_floor > self.open_margin_db) | ((above_floor > self.open_margin_db / 2) & speech_like))
+
+    if quietest_db < self.noise_floor_db:
+      self.noise_floor_db = max(MIN_NOISE_FLOOR_DB, (self.noise_floor_db + quietest_db) / 2)
+    else:
+      self.noise_floor_db = min(quietest_db, self.noise_floor_db + self.noise_rise_db_per_s * frame_s)
+
+    if active:
+      self._hangover_remaining_s = self.hangover_s
+      self.is_open = True
+    elif self._hangover_remaining_s > 0:
+      self._hangover_remaining_s -= frame_s
+      self.is_open = True
+    else:
+      self.is_open = False
+
+    if self.is_open:
+      self.open_frames += 1
+    else:
+      self.closed_frames += 1
+    return self.is_open
+
+  def reset(self) -> None:
+    # Closes the gate and drops the hangover. The noise floor is the room's and is kept, so
+    # the first frames after a reset are still judged against it.
+    self.is_open = False
+    self._hangover_remaining_s = 0.0
+
+  def skipped_fraction(self) -> float:
+    total = self.open_frames + self.closed_frames
+    return self.closed_frames / total if total else 0.0
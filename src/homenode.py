@@ -1,10 +1,34 @@
 import asyncio
 import json
+import os
+import struct
+import time
 import uuid
 import base64
+import numpy as np
 from typing import Optional, Dict, Any, AsyncIterator, TypedDict
 import aiomqtt
 from mqtt import MqttConnection
+from topic_router import DROP_OLDEST
+from publish_queue import PRIORITY_AUDIO, PRIORITY_CONTROL
+from audio_codecs import AudioCodec, get_codec
+from metrics import metrics
+
+# Empty uses the JSON/base64 request path, otherwise one of audio_codecs.CODECS
+UPLINK_CODEC = os.getenv('UPLINK_CODEC', '')
+BINARY_AUDIO_TOPIC = 'ai/live/audio'
+BINARY_AUDIO_VERSION = 1
+# version, codec id, session uuid, sequence number, capture timestamp (unix seconds)
+BINARY_AUDIO_HEADER = struct.Struct('<BB16sId')
+# Session responses carry the downlink audio and turn events. A consumer that falls this far
+# behind loses the oldest of them rather than holding up the MQTT read loop for everyone else.
+SESSION_RESPONSE_QUEUE_SIZE = 1024
+# Parsed events waiting for the session consumer. Once full the session subscription queues
+# up behind it, then drops.
+SESSION_EVENT_QUEUE_SIZE = 256
+# How long requests and uplink audio may wait out a broker reconnect before they are stale
+SESSION_REQUEST_TTL_S = 5.0
+AUDIO_PUBLISH_TTL_S = 5.0
 
 class RequestPayload(TypedDict):
   pattern: str
@@ -26,7 +50,23 @@ class Homenode:
   def __init__(self, mqtt: MqttConnection):
     self._mqtt = mqtt
     self._session_id: Optional[str] = None
-    self._event_queue: asyncio.Queue[ResponsePayloadData] = asyncio.Queue()
+    self._session_uuid: Optional[uuid.UUID] = None
+    # Whether startSession for the current session has been queued, so the server knows of it
+    self._session_requested = False
+    self._event_queue: asyncio.Queue[ResponsePayloadData] = asyncio.Queue(SESSION_EVENT_QUEUE_SIZE)
+    self._uplink_codec: Optional[AudioCodec] = get_codec(UPLINK_CODEC) if UPLINK_CODEC else None
+    self._audio_sequence = 0
+
+    self._session_open_time = metrics.histogram('homenode.session_open_ms')
+    self._send_audio_time = metrics.histogram('homenode.send_audio_ms')
+    self._sent_audio_bytes = metrics.counter('homenode.sent_audio_bytes')
+    self._received_events = metrics.counter('homenode.received_events')
+    self._failed_sessions = metrics.counter('homenode.failed_sessions')
+
+    for topic in ('ai/live/startSession', 'ai/live/endSession'):
+      mqtt.set_publish_policy(topic, PRIORITY_CONTROL, SESSION_REQUEST_TTL_S)
+    for topic in ('ai/live/request', BINARY_AUDIO_TOPIC):
+      mqtt.set_publish_policy(topic, PRIORITY_AUDIO, AUDIO_PUBLISH_TTL_S)
 
   async def connect(self) -> None:
     await self._mqtt.subscribe('aidev/chat/reply')
@@ -64,39 +104,97 @@ class Homenode:
     if self._session_id:
       raise RuntimeError('Session is already active')
 
-    self._session_id = f'live_{str(uuid.uuid4())}'
-    await self._send_request('ai/live/startSession', {'sessionId': self._session_id})
+    self._session_uuid = uuid.uuid4()
+    self._session_id = f'live_{str(self._session_uuid)}'
+    self._audio_sequence = 0
+    while not self._event_queue.empty():
+      self._event_queue.get_nowait()
 
+    # Subscribe before requesting the session so the open event cannot be missed
     response_topic = f'ai/live/{self._session_id}/response'
-    self._mqtt.register_handler(response_topic, self._handle_session_message)
+    self._mqtt.register_handler(response_topic, self._handle_session_message, SESSION_RESPONSE_QUEUE_SIZE, DROP_OLDEST, name='session_response')
     await self._mqtt.subscribe(response_topic)
 
-    await asyncio.wait_for(self.wait_for_open(), timeout=5.0)
+    session_request: Dict[str, Any] = {'sessionId': self._session_id}
+    if self._uplink_codec:
+      session_request['audioTopic'] = BINARY_AUDIO_TOPIC
+      session_request['audioCodec'] = self._uplink_codec.name
+    start = time.perf_counter()
+    # Set right before the request is queued, nothing can cancel this task in between
+    self._session_requested = True
+    await self._send_request('ai/live/startSession', session_request)
+
+    try:
+      await asyncio.wait_for(self.wait_for_open(), timeout=5.0)
+    except asyncio.TimeoutError:
+      self._failed_sessions.inc()
+      raise
+    self._session_open_time.observe_since(start)
+
+
+  async def cancel_session(self, session_task: asyncio.Task) -> None:
+    session_id = self._session_id
+    session_task.cancel()
+    try:
+      await session_task
+    except (asyncio.CancelledError, Exception):
+      pass
+    # Cancelled before startSession was queued the server never heard of the session, but the
+    # response subscription may already be in place. The local session is torn down even if
+    # endSession can't be sent, or the next wake would find it still active.
+    try:
+      if session_id and self._session_requested:
+        await self._send_request('ai/live/endSession', {'sessionId': session_id})
+    finally:
+      await self.end_session()
 
 
   async def end_session(self) -> None:
+    if not self._session_id:
+      return
     response_topic = f'ai/live/{self._session_id}/response'
     await self._mqtt.unsubscribe(response_topic)
     self._mqtt.unregister_handler(response_topic, self._handle_session_message)
     self._session_id = None
+    self._session_requested = False
 
   async def _handle_session_message(self, message: aiomqtt.Message) -> None:
     try:
       payload: ResponsePayload = json.loads(message.payload.decode())
       response_data = payload.get('data')
       if response_data:
+        self._received_events.inc()
         await self._event_queue.put(response_data)
     except (json.JSONDecodeError, KeyError):
       pass
 
 
-  async def send_audio(self, audio_data: bytes) -> None:
-    audio_base64 = base64.b64encode(audio_data).decode('utf-8')
-    await self._send_request('ai/live/request', {
-      'sessionId': self._session_id,
-      'audioBase64': audio_base64,
-      'mimeType': 'audio/pcm;rate=16000'
-    })
+  def encode_audio_packet(self, audio_data: bytes, capture_time: Optional[float] = None, sequence: Optional[int] = None) -> bytes:
+    if sequence is None:
+      sequence = self._audio_sequence
+    self._audio_sequence = sequence + 1
+    header = BINARY_AUDIO_HEADER.pack(
+      BINARY_AUDIO_VERSION,
+      self._uplink_codec.codec_id,
+      self._session_uuid.bytes,
+      sequence & 0xFFFFFFFF,
+      capture_time if capture_time is not None else time.time(),
+    )
+    return header + self._uplink_codec.encode(np.frombuffer(audio_data, dtype=np.int16))
+
+  async def send_audio(self, audio_data: bytes, capture_time: Optional[float] = None, sequence: Optional[int] = None) -> None:
+    start = time.perf_counter()
+    if self._uplink_codec:
+      await self._mqtt.publish(BINARY_AUDIO_TOPIC, self.encode_audio_packet(audio_data, capture_time, sequence))
+    else:
+      audio_base64 = base64.b64encode(audio_data).decode('utf-8')
+      await self._send_request('ai/live/request', {
+        'sessionId': self._session_id,
+        'audioBase64': audio_base64,
+        'mimeType': 'audio/pcm;rate=16000'
+      })
+    self._sent_audio_bytes.inc(len(audio_data))
+    self._send_audio_time.observe_since(start)
 
   async def get_events_stream(self) -> AsyncIterator[ResponsePayloadData]:
     while True:
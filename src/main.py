@@ -1,19 +1,33 @@
+from startup import startup_timer
 import sys
 import os
+import time
 import asyncio
-import base64
 import logging
-from typing import Optional, Coroutine, Any
-from audio import Audio
+from typing import Optional, Coroutine, Any, Union, TYPE_CHECKING
 from hardware import get_hardware, Hardware
 from light_patterns import FadePattern, RotatePattern, SingleColorPattern
-from wakeword_detector import WakeWordDetector
 from homenode import Homenode
 from mqtt import MqttConnection
-from wake_arbitration import WakeArbitration
+from wake_arbitration import WakeArbitration, DEVICE_ID
+from uplink import UplinkSender
+from downlink import DownlinkPlayer
+from metrics import metrics, MetricsPublisher
+
+# The audio stack (pyaudio, scipy, speexdsp) and openwakeword are imported by VoiceNode.start(),
+# concurrently with the rest of startup
+if TYPE_CHECKING:
+  from audio import Audio
+  from audio_engine import EngineAudio
+  from wakeword_detector import WakeWordDetector
+
+startup_timer.record('imports', startup_timer.process_start)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
+# Start opening the live session as soon as the wake word is heard, in parallel with arbitration
+SPECULATIVE_SESSION = os.getenv('SPECULATIVE_SESSION', '0') == '1'
+
 async def cleanup_task_if_exists(task: Optional[asyncio.Task]) -> None:
   if task:
     task.cancel()
@@ -31,72 +45,141 @@ async def race_tasks(*tasks: Coroutine[Any, Any, None]) -> None:
 
 class VoiceNode:
   def __init__(self) -> None:
-    self.hardware: Hardware = get_hardware()
-    self.hardware.set_leds_from_pattern(SingleColorPattern(0xFFFFFF10))
-    self.audio: Audio = Audio()
-    self.wakeword: WakeWordDetector = WakeWordDetector()
+    with startup_timer.phase('hardware'):
+      self.hardware: Hardware = get_hardware()
+      self.hardware.set_leds_from_pattern(SingleColorPattern(0xFFFFFF10))
+    # Created by start()
+    self.audio: Union['Audio', 'EngineAudio']
+    self.wakeword: 'WakeWordDetector'
+    self.downlink: DownlinkPlayer
     self.is_stream_open: bool = False
     self.mqtt: MqttConnection = MqttConnection()
 
     self.homenode: Homenode = Homenode(self.mqtt)
+    self.uplink: UplinkSender = UplinkSender(self.homenode.send_audio)
     self.arbitration: WakeArbitration = WakeArbitration(self.mqtt)
+    metrics.add_source('uplink', self.uplink.get_stats)
+    self.metrics_publisher: MetricsPublisher = MetricsPublisher(metrics, self.mqtt, f'voicenode/{DEVICE_ID}/metrics')
     self.session_end_signal: asyncio.Event = asyncio.Event()
+    self.session_start_position: Optional[int] = None
+    self.speculative_session: Optional[asyncio.Task] = None
+    self.wake_time: float = 0.0
+    self.last_wake_to_open_s: float = 0.0
+    self._mqtt_connect_task: Optional[asyncio.Task] = None
+    metrics.add_source('startup', startup_timer.get_stats)
+
+  async def start(self) -> None:
+    # Model loading, the audio device and DSP setup, and the MQTT connection don't depend on
+    # each other, so they are brought up concurrently. Loading runs in threads, which overlaps
+    # file and device I/O and the native code that releases the GIL. The wake word works
+    # without the broker, so startup doesn't wait for MQTT to finish connecting.
+    await self.hardware.setup()
+    await self._start_mqtt()
+    await asyncio.gather(self._start_audio(), asyncio.to_thread(self._load_wakeword))
+    from wakeword_detector import WAKEWORD_TAP, MODEL_FRAME_SIZE
+    self.audio.add_tap_listener(WAKEWORD_TAP, MODEL_FRAME_SIZE, self.wakeword.feed)
+    self.downlink = DownlinkPlayer(self.audio.write_data, self.audio.stop_output_immediately, self.audio.playout_level)
+    metrics.add_source('downlink', self.downlink.get_stats)
+    self.uplink.start()
+    self.metrics_publisher.start()
+
+  async def _start_mqtt(self) -> None:
+    start = time.monotonic()
+    await self.mqtt.connect(will=self.arbitration.presence_will())
+    await self.arbitration.connect()
+    await self.homenode.connect()
+
+    async def record_connect() -> None:
+      await self.mqtt.connected.wait()
+      startup_timer.record('mqtt_connect', start)
+      logging.info(f'MQTT connected {time.monotonic() - start:.2f}s into startup')
+    self._mqtt_connect_task = asyncio.create_task(record_connect())
+
+  async def _start_audio(self) -> None:
+    with startup_timer.phase('audio_init'):
+      self.audio = await asyncio.to_thread(self._create_audio)
+    with startup_timer.phase('audio_streams'):
+      await self.audio.setup_streams()
+
+  def _create_audio(self) -> Union['Audio', 'EngineAudio']:
+    from audio_engine import EngineAudio, AUDIO_ENGINE_PROCESS
+    if AUDIO_ENGINE_PROCESS:
+      return EngineAudio()
+    from audio import Audio
+    return Audio()
+
+  def _load_wakeword(self) -> None:
+    # Includes the warm-up pass whose state the detector restores on every reset
+    with startup_timer.phase('wakeword_model'):
+      from wakeword_detector import WakeWordDetector
+      self.wakeword = WakeWordDetector()
 
   async def wait_for_user(self) -> None:
-    self.wakeword.reset()
     async def wait_for_trigger() -> None:
       while True:
         try:
-          audio_data = await self.audio.read_data()
-          score = self.wakeword.detect(audio_data)
-          if score is None:
-            continue
-          should_handle = await self.arbitration.should_handle_request(score)
+          detection = await self.wakeword.wait_for_detection()
+          self.wake_time = time.monotonic()
+          session_task = asyncio.create_task(self.homenode.start_session()) if SPECULATIVE_SESSION else None
+          should_handle = False
+          try:
+            should_handle = await self.arbitration.should_handle_request(detection.score)
+          finally:
+            if session_task and not should_handle:
+              logging.info('Cancelling speculative session')
+              await self.homenode.cancel_session(session_task)
           if should_handle:
+            from audio import PREROLL_OFFSET_SAMPLES
+            self.session_start_position = detection.end_position + PREROLL_OFFSET_SAMPLES
+            self.speculative_session = session_task
             return
         except Exception as e:
           logging.error(f'failed waiting for user: {e}')
-    await race_tasks(wait_for_trigger(), self.hardware.wait_for_button_tap())
+
+    async def wait_for_button() -> None:
+      await self.hardware.wait_for_button_tap()
+      self.wake_time = time.monotonic()
+      self.session_start_position = self.audio.capture_position
+
+    self.wakeword.start_listening()
+    try:
+      await race_tasks(wait_for_trigger(), wait_for_button())
+    finally:
+      self.wakeword.stop_listening()
 
   async def _handle_audio_input(self) -> None:
-    buffered = b''
+    # Streaming starts from the pre-roll ring at the wake word, so speech during arbitration and
+    # session start is kept. Audio is queued in the uplink sender until the session opens.
+    reader = self.audio.open_capture_reader(self.session_start_position)
     while not self.session_end_signal.is_set():
-      audio_data = await self.audio.read_data()
-      if self.is_stream_open:
-        if buffered:
-          await self.homenode.send_audio(buffered)
-          buffered = b''
-        await self.homenode.send_audio(audio_data)
-      else:
-        buffered += audio_data
+      audio_data, capture_time = await reader.read()
+      self.uplink.push(audio_data, capture_time)
 
   async def _handle_event_stream(self) -> None:
     thinking_lights = RotatePattern(0x1111FFAA, 0x0000FF99)
     waiting_for_user_lights = SingleColorPattern(0x0000FFAA)
+    from audio import parse_pcm_sample_rate
     async for event in self.homenode.get_events_stream():
       if event['type'] != 'audio':
         logging.info(f"Event: {event}")
       if event['type'] == 'audio':
-        audio_data = base64.b64decode(event['audioBase64'])
-        self.audio.write_24khz_data(audio_data)
+        # Decoded and resampled on the downlink thread
+        self.downlink.push(event['audioBase64'], parse_pcm_sample_rate(event.get('mimeType')))
         self.hardware.set_leds_from_pattern(waiting_for_user_lights)
       elif event['type'] == 'interrupted':
-        self.audio.stop_output_immediately()
+        self.downlink.interrupt()
       elif event['type'] == 'close':
+        self.downlink.end_turn()
         self.session_end_signal.set()
       elif event['type'] == 'inputTranscription':
         self.hardware.set_leds_from_pattern(thinking_lights)
       elif event['type'] == 'turnComplete':
+        self.downlink.end_turn()
         self.hardware.set_leds_from_pattern(waiting_for_user_lights)
 
   async def run(self) -> None:
-    await self.hardware.setup()
-
-    await self.mqtt.connect()
-    await self.arbitration.connect()
-    await self.homenode.connect()
-
-    await self.audio.setup_streams()
+    await self.start()
+    startup_timer.ready()
 
     audio_input_task: Optional[asyncio.Task] = None
     event_stream_task: Optional[asyncio.Task] = None
@@ -111,11 +194,18 @@ class VoiceNode:
         self.hardware.set_leds_from_pattern(RotatePattern(0x1111FF10, 0x0000FF10))
         self.session_end_signal.clear()
 
+        self.uplink.begin()
         audio_input_task = asyncio.create_task(self._handle_audio_input())
 
-        await self.homenode.start_session()
+        if self.speculative_session:
+          session_task, self.speculative_session = self.speculative_session, None
+          await session_task
+        else:
+          await self.homenode.start_session()
         self.is_stream_open = True
-        logging.info('Live session started')
+        self.uplink.open()
+        self.last_wake_to_open_s = time.monotonic() - self.wake_time
+        logging.info(f'Live session started {self.last_wake_to_open_s * 1000:.0f}ms after wake')
 
         event_stream_task = asyncio.create_task(self._handle_event_stream())
 
@@ -131,6 +221,8 @@ class VoiceNode:
         self.is_stream_open = False
         logging.info('Live session ended')
         await cleanup_task_if_exists(audio_input_task)
+        logging.info(f'Uplink stats: {self.uplink.get_stats()}')
+        self.uplink.end()
         await self.homenode.end_session()
         await cleanup_task_if_exists(event_stream_task)
 
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_right
+from typing import Callable, Dict, Optional, TYPE_CHECKING
+
+# mqtt imports this module for its dispatch metrics
+if TYPE_CHECKING:
+  from mqtt import MqttConnection
+
+METRICS_INTERVAL_S = float(os.getenv('METRICS_INTERVAL_S', '10'))
+# When set, every snapshot is also written to this file as plain text
+METRICS_DUMP_PATH = os.getenv('METRICS_DUMP_PATH', '')
+# Bucket upper bounds in milliseconds, roughly 1.5x apart from 50us to 2s
+LATENCY_BUCKETS_MS = tuple(round(0.05 * 1.5 ** i, 3) for i in range(27))
+
+
+class Counter:
+  def __init__(self) -> None:
+    self.value = 0
+
+  def inc(self, amount: int = 1) -> None:
+    self.value += amount
+
+
+class Histogram:
+  # Fixed buckets allocated up front so recording is a bisect and a couple of additions,
+  # cheap enough to leave on in the audio callback
+  def __init__(self, bounds: tuple[float, ...] = LATENCY_BUCKETS_MS) -> None:
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def observe(self, value: float) -> None:
+    self.counts[bisect_right(self.bounds, value)] += 1
+    self.count += 1
+    self.total += value
+    if value > self.max:
+      self.max = value
+
+  def observe_since(self, start: float) -> None:
+    self.observe((time.perf_counter() - start) * 1000)
+
+  def percentile(self, fraction: float) -> float:
+    if not self.count:
+      return 0.0
+    target = fraction * self.count
+    seen = 0
+    for i, bucket_count in enumerate(self.counts):
+      seen += bucket_count
+      if seen >= target:
+        return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+    return self.max
+
+  def snapshot(self) -> Dict[str, float]:
+    return {
+      'count': self.count,
+      'avg': self.total / self.count if self.count else 0.0,
+      'p50': self.percentile(0.5),
+      'p95': self.percentile(0.95),
+      'p99': self.percentile(0.99),
+      'max': self.max,
+    }
+
+
+class MetricsRegistry:
+  def __init__(self) -> None:
+    self.counters: Dict[str, Counter] = {}
+    self.histograms: Dict[str, Histogram] = {}
+    self.gauges: Dict[str, Callable[[], float]] = {}
+    self.sources: Dict[str, Callable[[], Dict[str, float]]] = {}
+
+  def counter(self, name: str) -> Counter:
+    if name not in self.counters:
+      self.counters[name] = Counter()
+    return self.counters[name]
+
+  def histogram(self, name: str, bounds: tuple[float, ...] = LATENCY_BUCKETS_MS) -> Histogram:
+    if name not in self.histograms:
+      self.histograms[name] = Histogram(bounds)
+    return self.histograms[name]
+
+  def gauge(self, name: str, read: Callable[[], float]) -> None:
+    # Gauges are read when a snapshot is taken, never on the hot path
+    self.gauges[name] = read
+
+  def add_source(self, prefix: str, get_stats: Callable[[], Dict[str, float]]) -> None:
+    self.sources[prefix] = get_stats
+
+  def snapshot(self) -> Dict[str, object]:
+    snapshot: Dict[str, object] = {name: counter.value for name, counter in self.counters.items()}
+    snapshot.update({name: histogram.snapshot() for name, histogram in self.histograms.items()})
+    for name, read in self.gauges.items():
+      try:
+        snapshot[name] = read()
+      except Exception as e:
+        logging.warning(f'Failed to read gauge {name}: {e}')
+    for prefix, get_stats in self.sources.items():
+      try:
+        snapshot.update({f'{prefix}.{key}': value for key, value in get_stats().items()})
+      except Exception as e:
+        logging.warning(f'Failed to read stats for {prefix}: {e}')
+    return snapshot
+
+
+def format_text(snapshot: Dict[str, object]) -> str:
+  lines = []
+  for name in sorted(snapshot):
+    value = snapshot[name]
+    if isinstance(value, dict):
+      value = ' '.join(f'{key}={item:.3f}' if isinstance(item, float) else f'{key}={item}' for key, item in value.items())
+    elif isinstance(value, float):
+      value = f'{value:.3f}'
+    lines.append(f'{name} {value}')
+  return '\n'.join(lines) + '\n'
+
+
+class MetricsPublisher:
+  def __init__(self, registry: MetricsRegistry, mqtt: 'MqttConnection', topic: str, interval_s: float = METRICS_INTERVAL_S, dump_path: str = METRICS_DUMP_PATH) -> None:
+    self._registry = registry
+    self._mqtt = mqtt
+    self.topic = topic
+    self.interval_s = interval_s
+    self.dump_path = dump_path
+    self._task: Optional[asyncio.Task] = None
+    # Imported here for the same reason as mqtt above. A snapshot is stale once the next is due.
+    from publish_queue import PRIORITY_BACKGROUND
+    mqtt.set_publish_policy(topic, PRIORITY_BACKGROUND, interval_s)
+
+  def start(self) -> None:
+    if self.interval_s > 0 and not self._task:
+      self._task = asyncio.create_task(self._publish_loop())
+
+  async def _publish_loop(self) -> None:
+    while True:
+      await asyncio.sleep(self.interval_s)
+      snapshot = {'timestamp': time.time(), **self._registry.snapshot()}
+      try:
+        await self._mqtt.publish(self.topic, json.dumps(snapshot))
+      except Exception as e:
+        logging.warning(f'Failed to publish metrics: {e}')
+      if self.dump_path:
+        try:
+          await asyncio.to_thread(self._dump, format_text(snapshot))
+        except OSError as e:
+          logging.warning(f'Failed to write metrics to {self.dump_path}: {e}')
+
+  def _dump(self, text: str) -> None:
+    with open(self.dump_path, 'w') as f:
+      f.write(text)
+
+
+metrics = MetricsRegistry()
@@ -1,8 +1,19 @@
 import asyncio
 import logging
-from typing import Optional, Callable, Awaitable, Dict, Set
+import random
+from typing import Optional, Callable, Awaitable, Set, Union
 import aiomqtt
 import os
+from topic_router import TopicRouter, DEFAULT_QUEUE_SIZE, DROP_OLDEST
+from publish_queue import PendingPublish, PublishQueue, PUBLISH_QUEUE_SIZE
+from metrics import metrics
+
+# Publishes handed to the client at once, each waits for its own write (or broker ack at QoS 1)
+PUBLISH_WINDOW = int(os.getenv('MQTT_PUBLISH_WINDOW', '8'))
+# Reconnect delay doubles from the minimum up to the maximum, with jitter so nodes that lost
+# the broker together don't all come back at the same instant
+RECONNECT_MIN_S = 0.2
+RECONNECT_MAX_S = 5.0
 
 class MqttConnection:
   def __init__(self) -> None:
@@ -10,50 +21,99 @@ class MqttConnection:
     self._port = int(os.getenv('MQTT_PORT', '1883'))
     self.client: Optional[aiomqtt.Client] = None
     self._reconnect_task: Optional[asyncio.Task] = None
-    self._message_handlers: Dict[str, Set[Callable[[aiomqtt.Message], Awaitable[None]]]] = {}
+    # Handlers run on their own worker tasks, so a slow one never holds up the read loop
+    self._router = TopicRouter()
+    metrics.add_source('mqtt', self._router.get_stats)
     self._subscriptions: Set[str] = set()
     self._is_connected: bool = False
+    self.connected: asyncio.Event = asyncio.Event()
+    # Outbound messages wait here while disconnected, so a short outage only delays them
+    self._publish_queue = PublishQueue(int(os.getenv('MQTT_PUBLISH_QUEUE', str(PUBLISH_QUEUE_SIZE))))
+    self._publish_task: Optional[asyncio.Task] = None
+    # The loop only keeps weak references to tasks, so in-flight sends are held here
+    self._send_tasks: Set[asyncio.Task] = set()
+    self._reconnects = metrics.counter('mqtt.reconnects')
+    metrics.add_source('mqtt.publish', self._publish_queue.get_stats)
 
-  async def connect(self) -> None:
-    self.client = aiomqtt.Client(hostname=self._hostname, port=self._port, keepalive=5)
+  async def connect(self, will: Optional[aiomqtt.Will] = None) -> None:
+    self.client = aiomqtt.Client(hostname=self._hostname, port=self._port, keepalive=5, will=will)
     if self._reconnect_task:
       return
     self._reconnect_task = asyncio.create_task(self._reconnect_loop())
+    self._publish_task = asyncio.create_task(self._publish_loop())
 
   async def _reconnect_loop(self) -> None:
+    attempt = 0
     while True:
       try:
         async with self.client:
           self._is_connected = True
           for topic in self._subscriptions:
             await self.client.subscribe(topic)
+          self.connected.set()
+          attempt = 0
           logging.info("MQTT connected.")
           async for message in self.client.messages:
             await self._handle_message(message)
       except aiomqtt.MqttError as e:
         self._is_connected = False
-        logging.warning(f"MQTT connection lost; Reconnecting in 5 seconds... {e}")
-        await asyncio.sleep(5)
+        self.connected.clear()
+        self._reconnects.inc()
+        delay = min(RECONNECT_MAX_S, RECONNECT_MIN_S * 2 ** attempt) * random.uniform(0.5, 1.0)
+        attempt += 1
+        logging.warning(f"MQTT connection lost; Reconnecting in {delay:.1f} seconds... {e}")
+        await asyncio.sleep(delay)
+
+  async def _publish_loop(self) -> None:
+    window = asyncio.Semaphore(PUBLISH_WINDOW)
+    while True:
+      await self.connected.wait()
+      await window.acquire()
+      pending = await self._publish_queue.get()
+      if not self.connected.is_set():
+        # Lost the connection while waiting, leave the message queued for the next one
+        self._publish_queue.requeue(pending)
+        window.release()
+        continue
+      # Tasks start in creation order, so messages reach the client in queue order
+      task = asyncio.create_task(self._send(pending, window))
+      self._send_tasks.add(task)
+      task.add_done_callback(self._send_tasks.discard)
+
+  async def _send(self, pending: PendingPublish, window: asyncio.Semaphore) -> None:
+    try:
+      await self.client.publish(pending.topic, pending.payload, retain=pending.retain)
+      self._publish_queue.sent(pending)
+    except aiomqtt.MqttError as e:
+      logging.debug(f'MQTT publish to {pending.topic} failed, retrying: {e}')
+      # Attempts only count while the connection still looks up. The pause before retrying
+      # usually gives the reconnect loop time to notice a dead connection.
+      attempts = pending.attempts + self.connected.is_set()
+      await asyncio.sleep(RECONNECT_MIN_S)
+      self._publish_queue.requeue(pending._replace(attempts=attempts))
+    except Exception as e:
+      # Not a connection problem, so retrying won't help
+      logging.error(f'MQTT publish to {pending.topic} failed: {e}')
+      self._publish_queue.failed(pending)
+    finally:
+      window.release()
 
   async def _handle_message(self, message: aiomqtt.Message) -> None:
-    topic = str(message.topic)
-    if topic in self._message_handlers:
-      for handler in self._message_handlers[topic]:
-        try:
-          await handler(message)
-        except Exception as e:
-          logging.error(f"Error in message handler for {topic}: {e}")
+    await self._router.dispatch(message)
 
-  def register_handler(self, topic: str, handler: Callable[[aiomqtt.Message], Awaitable[None]]) -> None:
-    if topic not in self._message_handlers:
-      self._message_handlers[topic] = set()
-    self._message_handlers[topic].add(handler)
+  def register_handler(
+    self,
+    topic: str,
+    handler: Callable[[aiomqtt.Message], Awaitable[None]],
+    max_queue: int = DEFAULT_QUEUE_SIZE,
+    overflow_policy: str = DROP_OLDEST,
+    name: Optional[str] = None,
+  ) -> None:
+    # topic may use the + and # wildcards. name labels the handler's metrics, and defaults to the topic.
+    self._router.add(topic, handler, max_queue, overflow_policy, name)
 
   def unregister_handler(self, topic: str, handler: Callable[[aiomqtt.Message], Awaitable[None]]) -> None:
-    if topic in self._message_handlers:
-      self._message_handlers[topic].discard(handler)
-      if not self._message_handlers[topic]:
-        del self._message_handlers[topic]
+    self._router.remove(topic, handler)
 
   async def subscribe(self, topic: str) -> None:
     self._subscriptions.add(topic)
@@ -65,7 +125,13 @@ class MqttConnection:
     if self._is_connected:
       await self.client.unsubscribe(topic)
 
-  async def publish(self, topic: str, payload: str, retain: bool = False) -> None:
-    if not self._is_connected:
-      raise RuntimeError('MQTT not connected')
-    await self.client.publish(topic, payload, retain=retain)
+  def set_publish_policy(self, topic: str, priority: int, ttl_s: Optional[float] = None) -> None:
+    # topic may use the + and # wildcards. Messages older than ttl_s when their turn comes are dropped.
+    self._publish_queue.set_policy(topic, priority, ttl_s)
+
+  async def publish(self, topic: str, payload: Union[str, bytes], retain: bool = False, wait: bool = True) -> None:
+    # Queues the message by its topic's priority. With wait, returns once it is written to the
+    # connection and raises RuntimeError if it was dropped or expired first.
+    future = self._publish_queue.put(topic, payload, retain, wait)
+    if future:
+      await future
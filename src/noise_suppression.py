@@ -0,0 +1,141 @@
+import numpy as np
+from abc import ABC, abstractmethod
+from typing import Optional
+
+NR_BACKENDS = ('spectral_gate', 'wiener')
+SPECTRAL_GATE_TIME_CONSTANT_S = 0.256
+
+
+class NoiseSuppressor(ABC):
+  # Streaming noise suppression stage. process() takes any number of int16 samples and
+  # returns the int16 samples that are complete, trailing the input by `latency` samples.
+  latency: int
+
+  @abstractmethod
+  def process(self, audio: np.ndarray) -> np.ndarray:
+    pass
+
+  @abstractmethod
+  def reset(self) -> None:
+    pass
+
+
+class WienerSuppressor(NoiseSuppressor):
+  # Single pass STFT suppressor: a recursive per-bin noise tracker (follows drops quickly,
+  # averages while the bin looks like noise, otherwise only creeps up) and a Wiener gain
+  # from a decision-directed a priori SNR. Square-root Hann windows at 50% overlap keep the
+  # latency to one hop, and there is no mask smoothing beyond the decision-directed recursion.
+  # Nothing loops over frames in Python: each call gates its frames against the noise floor
+  # of the previous call before updating it once, and the decision-directed term takes the
+  # previous frame's clean power from its maximum likelihood gain. With decision_directed=0
+  # the gain comes straight from each frame's SNR.
+  def __init__(
+    self,
+    sample_rate: int = 16000,
+    n_fft: int = 512,
+    noise_time_constant_s: float = 0.5,
+    noise_rise_db_per_s: float = 3.0,
+    speech_threshold: float = 4.0,
+    decision_directed: float = 0.96,
+    max_attenuation_db: float = 10.0,
+  ) -> None:
+    self.sample_rate = sample_rate
+    self.n_fft = n_fft
+    self.hop_length = n_fft // 2
+    hop_s = self.hop_length / sample_rate
+    self._noise_alpha = np.exp(-hop_s / noise_time_constant_s)
+    self._noise_rise = 10 ** (noise_rise_db_per_s * hop_s / 10)
+    self._speech_threshold = speech_threshold
+    self._decision_directed = decision_directed
+    self._gain_floor = 10 ** (-max_attenuation_db / 20)
+
+    self._window = np.sqrt(np.hanning(n_fft + 1)[:n_fft])
+    self.latency = self.n_fft - self.hop_length
+    self.reset()
+
+  def reset(self) -> None:
+    self._pending = np.zeros(0, dtype=np.float64)
+    self._input_tail = np.zeros(self.n_fft - self.hop_length, dtype=np.float64)
+    self._output_tail = np.zeros(self.n_fft - self.hop_length, dtype=np.float64)
+    self._noise: Optional[np.ndarray] = None
+    self._clean_power = np.zeros(self.n_fft // 2 + 1, dtype=np.float64)
+
+  def process(self, audio: np.ndarray) -> np.ndarray:
+    samples = np.concatenate([self._pending, audio.astype(np.float64)])
+    n_hops = len(samples) // self.hop_length
+    self._pending = samples[n_hops * self.hop_length:]
+    if n_hops == 0:
+      return np.zeros(0, dtype=np.int16)
+
+    signal = np.concatenate([self._input_tail, samples[:n_hops * self.hop_length]])
+    self._input_tail = signal[-len(self._input_tail):]
+    frames = np.lib.stride_tricks.sliding_window_view(signal, self.n_fft)[::self.hop_length]
+    stft = np.fft.rfft(frames * self._window, axis=1)
+    power = stft.real ** 2 + stft.imag ** 2
+
+    if self._noise is None:
+      self._noise = power[0] + 1e-10
+    gains = self._gains(power)
+    self._update_noise(power)
+
+    denoised_frames = np.fft.irfft(stft * gains, n=self.n_fft, axis=1) * self._window
+    output = np.zeros((n_hops + 1) * self.hop_length, dtype=np.float64)
+    output[:n_hops * self.hop_length] += denoised_frames[:, :self.hop_length].reshape(-1)
+    output[self.hop_length:] += denoised_frames[:, self.hop_length:].reshape(-1)
+    output[:len(self._output_tail)] += self._output_tail
+    self._output_tail = output[n_hops * self.hop_length:]
+
+    return np.clip(output[:n_hops * self.hop_length], -32768, 32767).astype(np.int16)
+
+  def _gains(self, power: np.ndarray) -> np.ndarray:
+    # Maximum likelihood a priori SNR, gamma - 1
+    snr = np.maximum(power / self._noise - 1, 0)
+    gains = np.maximum(snr / (1 + snr), self._gain_floor)
+    if self._decision_directed:
+      previous_clean_power = np.concatenate([self._clean_power[np.newaxis], gains[:-1] ** 2 * power[:-1]])
+      snr = self._decision_directed * previous_clean_power / self._noise + (1 - self._decision_directed) * snr
+      gains = np.maximum(snr / (1 + snr), self._gain_floor)
+      self._clean_power = gains[-1] ** 2 * power[-1]
+    return gains
+
+  def _update_noise(self, power: np.ndarray) -> None:
+    # One recursive step per noise-like frame in the block, or the slow rise if there were none
+    noise = self._noise
+    likely_noise = power < self._speech_threshold * noise
+    counts = likely_noise.sum(axis=0)
+    noise_mean = (power * likely_noise).sum(axis=0) / np.maximum(counts, 1)
+    weight = self._noise_alpha ** counts
+    self._noise = np.maximum(np.where(counts > 0, noise * weight + noise_mean * (1 - weight), noise * self._noise_rise ** len(power)), 1e-10)
+
+
+def create_noise_suppressor(backend: str, sample_rate: int = 16000, reduced: bool = False) -> NoiseSuppressor:
+  # reduced gives the cheaper variant used when the processor is shedding load
+  if backend == 'spectral_gate':
+    # Imported here so nodes running the Wiener backend never load scipy.signal
+    from streaming_nr import StreamingSpectralGate
+    if reduced:
+      # Half as many FFT frames per second and no mask smoothing
+      return StreamingSpectralGate(
+        sample_rate=sample_rate,
+        n_fft=512,
+        hop_length=256,
+        time_constant_s=SPECTRAL_GATE_TIME_CONSTANT_S,
+        thresh_n_mult=4,
+        sigmoid_slope=20,
+        prop_decrease=0.7,
+        smooth_mask=False,
+      )
+    return StreamingSpectralGate(
+      sample_rate=sample_rate,
+      n_fft=1024,
+      time_constant_s=SPECTRAL_GATE_TIME_CONSTANT_S,
+      freq_mask_smooth_hz=500,
+      time_mask_smooth_ms=64,
+      thresh_n_mult=4,
+      sigmoid_slope=20,
+      prop_decrease=0.7,
+    )
+  if backend == 'wiener':
+    # The reduced variant drops the decision-directed smoothing
+    return WienerSuppressor(sample_rate=sample_rate, decision_directed=0.0 if reduced else 0.96)
+  raise ValueError(f'Unknown noise suppression backend: {backend}')
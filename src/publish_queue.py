@@ -0,0 +1,186 @@
+import asyncio
+import time
+from collections import deque
+from typing import NamedTuple, Optional, Union
+from metrics import metrics
+from topic_router import TopicTrie
+
+# Lower goes first. Control covers arbitration and session requests, which are small and
+# time critical, so they never wait behind a backlog of audio or metrics.
+PRIORITY_CONTROL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_AUDIO = 2
+PRIORITY_BACKGROUND = 3
+PRIORITY_NAMES = ('control', 'normal', 'audio', 'background')
+PUBLISH_QUEUE_SIZE = 512
+# Sends that fail while the connection still looks up before the message is given up on
+PUBLISH_MAX_ATTEMPTS = 3
+
+
+class TopicPolicy(NamedTuple):
+  priority: int = PRIORITY_NORMAL
+  # Seconds a message may wait to be sent before it is dropped as stale, None keeps it
+  # for as long as the queue has room
+  ttl_s: Optional[float] = None
+
+
+class PendingPublish(NamedTuple):
+  topic: str
+  payload: Union[str, bytes]
+  retain: bool
+  priority: int
+  enqueued_time: float
+  expires: Optional[float]
+  # Resolved once the message is handed to the broker connection, None if nobody waits on it
+  future: Optional[asyncio.Future]
+  attempts: int = 0
+  # Fails the future once the TTL passes, cancelled when the message is sent or dropped
+  expiry: Optional[asyncio.TimerHandle] = None
+
+
+class PublishQueue:
+  # Outbound messages, one FIFO per priority. Bounded in total: when full the oldest message
+  # of the lowest priority present makes room, and a message of lower priority than
+  # everything queued is refused instead. Expired messages are dropped when they reach the
+  # front, or earlier when their room is needed. A message someone waits on is also failed
+  # as soon as it expires, since nothing reaches the front while disconnected.
+  def __init__(self, max_size: int = PUBLISH_QUEUE_SIZE) -> None:
+    self.max_size = max_size
+    self._policies: TopicTrie[TopicPolicy] = TopicTrie()
+    self._queues: list[deque[PendingPublish]] = [deque() for _ in PRIORITY_NAMES]
+    self._available = asyncio.Event()
+
+    self.queued = 0
+    self.published = 0
+    self.dropped = 0
+    self.expired = 0
+    self.requeued = 0
+    self.max_backlog = 0
+    self._latency = [metrics.histogram(f'mqtt.publish.{name}.latency_ms') for name in PRIORITY_NAMES]
+
+  def set_policy(self, topic_filter: str, priority: int, ttl_s: Optional[float] = None) -> None:
+    if not 0 <= priority < len(PRIORITY_NAMES):
+      raise ValueError(f'Unknown publish priority: {priority}')
+    self._policies.insert(topic_filter, TopicPolicy(priority, ttl_s))
+
+  def policy(self, topic: str) -> TopicPolicy:
+    # The most urgent of the matching filters wins
+    return min(self._policies.match(topic), key=lambda policy: policy.priority, default=TopicPolicy())
+
+  def put(self, topic: str, payload: Union[str, bytes], retain: bool = False, wait: bool = True) -> Optional[asyncio.Future]:
+    policy = self.policy(topic)
+    loop = asyncio.get_running_loop()
+    now = time.monotonic()
+    pending = PendingPublish(
+      topic,
+      payload,
+      retain,
+      policy.priority,
+      now,
+      now + policy.ttl_s if policy.ttl_s is not None else None,
+      loop.create_future() if wait else None,
+    )
+    self.queued += 1
+    if len(self) >= self.max_size:
+      self._drop_expired(now)
+    if len(self) >= self.max_size and not self._drop_lowest(pending.priority):
+      self._fail(pending, 'dropped')
+      self.dropped += 1
+      return pending.future
+    if pending.future and policy.ttl_s is not None:
+      pending = pending._replace(expiry=loop.call_later(policy.ttl_s, self._expire, pending.future, pending.priority))
+    self._queues[pending.priority].append(pending)
+    self.max_backlog = max(self.max_backlog, len(self))
+    self._available.set()
+    return pending.future
+
+  def requeue(self, pending: PendingPublish) -> None:
+    # Puts back a message the connection failed to send, ahead of anything queued after it
+    if pending.attempts >= PUBLISH_MAX_ATTEMPTS:
+      self.failed(pending)
+      return
+    self.requeued += 1
+    messages = self._queues[pending.priority]
+    index = 0
+    while index < len(messages) and messages[index].enqueued_time <= pending.enqueued_time:
+      index += 1
+    messages.insert(index, pending)
+    self._available.set()
+
+  async def get(self) -> PendingPublish:
+    while True:
+      now = time.monotonic()
+      for messages in self._queues:
+        while messages:
+          pending = messages.popleft()
+          if pending.expires is not None and now >= pending.expires:
+            self._fail(pending, 'expired')
+            self.expired += 1
+            continue
+          return pending
+      self._available.clear()
+      await self._available.wait()
+
+  def sent(self, pending: PendingPublish) -> None:
+    if pending.expiry:
+      pending.expiry.cancel()
+    self.published += 1
+    # From publish() to written out, so time spent queued or waiting for a reconnect counts
+    self._latency[pending.priority].observe((time.monotonic() - pending.enqueued_time) * 1000)
+    if pending.future and not pending.future.done():
+      pending.future.set_result(None)
+
+  def failed(self, pending: PendingPublish) -> None:
+    # Gives up on a message the connection could not send
+    self._fail(pending, 'failed')
+    self.dropped += 1
+
+  def _expire(self, future: asyncio.Future, priority: int) -> None:
+    # Only while still queued, a message already handed to the connection gets its own outcome
+    messages = self._queues[priority]
+    for index, pending in enumerate(messages):
+      if pending.future is future:
+        del messages[index]
+        self._fail(pending, 'expired')
+        self.expired += 1
+        return
+
+  def _drop_expired(self, now: float) -> None:
+    for index, messages in enumerate(self._queues):
+      live = deque(pending for pending in messages if pending.expires is None or now < pending.expires)
+      for pending in messages:
+        if pending.expires is not None and now >= pending.expires:
+          self._fail(pending, 'expired')
+          self.expired += 1
+      self._queues[index] = live
+
+  def _drop_lowest(self, priority: int) -> bool:
+    for messages in reversed(self._queues[priority:]):
+      if messages:
+        self._fail(messages.popleft(), 'dropped')
+        self.dropped += 1
+        return True
+    return False
+
+  def _fail(self, pending: PendingPublish, reason: str) -> None:
+    if pending.expiry:
+      pending.expiry.cancel()
+    if pending.future and not pending.future.done():
+      pending.future.set_exception(RuntimeError(f'MQTT publish to {pending.topic} {reason}'))
+
+  def __len__(self) -> int:
+    return sum(len(messages) for messages in self._queues)
+
+  def get_stats(self) -> dict[str, float]:
+    stats: dict[str, float] = {
+      'backlog': len(self),
+      'max_backlog': self.max_backlog,
+      'queued': self.queued,
+      'published': self.published,
+      'dropped': self.dropped,
+      'expired': self.expired,
+      'requeued': self.requeued,
+    }
+    for name, messages in zip(PRIORITY_NAMES, self._queues):
+      stats[f'{name}.backlog'] = len(messages)
+    return stats
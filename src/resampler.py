@@ -0,0 +1,48 @@
+import numpy as np
+from math import gcd
+from scipy.signal import firwin
+
+
+class StreamingResampler:
+  # Polyphase resampler for any rational ratio. Uses the same kaiser FIR design as
+  # scipy's resample_poly, but keeps the filter history between calls so every input
+  # sample is filtered exactly once and chunk boundaries are seamless.
+  def __init__(self, input_rate: int, output_rate: int) -> None:
+    divisor = gcd(input_rate, output_rate)
+    self.input_rate = input_rate
+    self.output_rate = output_rate
+    self.up = output_rate // divisor
+    self.down = input_rate // divisor
+
+    max_rate = max(self.up, self.down)
+    half_len = 10 * max_rate
+    taps = firwin(2 * half_len + 1, 1.0 / max_rate, window=('kaiser', 5.0)) * self.up
+    self._taps_per_phase = -(-len(taps) // self.up)
+    taps = np.pad(taps, (0, self._taps_per_phase * self.up - len(taps)))
+    # Row p holds the taps for output phase p, reversed to line up with an input window
+    self._phases = np.ascontiguousarray(taps.reshape(self._taps_per_phase, self.up).T[:, ::-1], dtype=np.float32)
+    self.reset()
+
+  def reset(self) -> None:
+    self._history = np.zeros(self._taps_per_phase - 1, dtype=np.float32)
+    self._input_count = 0
+    self._output_count = 0
+
+  def process(self, samples: np.ndarray) -> np.ndarray:
+    if self.up == self.down:
+      return samples.astype(np.int16)
+
+    extended = np.concatenate([self._history, samples.astype(np.float32)])
+    total_input = self._input_count + len(samples)
+    output_end = -(-total_input * self.up // self.down)
+    output_positions = np.arange(self._output_count, output_end, dtype=np.int64) * self.down
+    input_index = output_positions // self.up - self._input_count
+    phase = output_positions % self.up
+
+    windows = np.lib.stride_tricks.sliding_window_view(extended, self._taps_per_phase)[input_index]
+    output = np.einsum('ij,ij->i', windows, self._phases[phase])
+
+    self._history = extended[len(extended) - len(self._history):]
+    self._input_count = total_input
+    self._output_count = output_end
+    return np.clip(np.rint(output), -32768, 32767).astype(np.int16)
@@ -0,0 +1,209 @@
+import multiprocessing
+import threading
+import numpy as np
+from multiprocessing import shared_memory
+from typing import Any, Optional, Dict
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+# History rings keep the latest capacity samples for read_history(), overwriting without counting drops
+OVERWRITE = 'overwrite'
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, OVERWRITE)
+
+
+class RingBuffer:
+  # Fixed capacity int16 ring with one row per channel. The first max_read samples are
+  # mirrored past the end of the buffer so any read of up to max_read samples is a
+  # contiguous zero-copy view. Positions are absolute sample counts since creation.
+  def __init__(self, capacity: int, channels: int = 1, max_read: Optional[int] = None, overflow_policy: str = DROP_OLDEST) -> None:
+    if overflow_policy not in OVERFLOW_POLICIES:
+      raise ValueError(f'Unknown overflow policy: {overflow_policy}')
+    self.capacity = capacity
+    self.channels = channels
+    self.max_read = min(max_read or capacity, capacity)
+    self.overflow_policy = overflow_policy
+    self._buffer = np.zeros((channels, capacity + self.max_read), dtype=np.int16)
+    self._write_count = 0
+    self._read_count = 0
+    self._peek_position: Optional[int] = None
+    self.written_samples = 0
+    self.dropped_samples = 0
+    self.overflows = 0
+    self._lock = threading.Lock()
+    self._data_available = threading.Condition(self._lock)
+
+  def _copy_in(self, pos: int, samples: list[np.ndarray], start: int, length: int) -> None:
+    for channel, data in enumerate(samples):
+      self._buffer[channel, pos:pos + length] = data[start:start + length]
+    if pos < self.max_read:
+      mirror_end = min(pos + length, self.max_read)
+      self._buffer[:, self.capacity + pos:self.capacity + mirror_end] = self._buffer[:, pos:mirror_end]
+
+  def write(self, *samples: np.ndarray) -> int:
+    length = min(len(data) for data in samples)
+    with self._lock:
+      free = self.capacity - (self._write_count - self._read_count)
+      start = 0
+      if length > free:
+        if self.overflow_policy != OVERWRITE:
+          self.overflows += 1
+          self.dropped_samples += length - free
+        if self.overflow_policy == DROP_NEWEST:
+          length = free
+        else:
+          if length > self.capacity:
+            # The head of an oversized write is overwritten straight away, but still counts
+            # towards the absolute positions
+            start = length - self.capacity
+            self._write_count += start
+            length = self.capacity
+          self._read_count = self._write_count + length - self.capacity
+
+      pos = self._write_count % self.capacity
+      first = min(length, self.capacity - pos)
+      if first > 0:
+        self._copy_in(pos, samples, start, first)
+      if length > first:
+        self._copy_in(0, samples, start + first, length - first)
+
+      self._write_count += length
+      self.written_samples += length
+      if length > 0:
+        self._data_available.notify_all()
+      return length
+
+  @property
+  def available(self) -> int:
+    return self._write_count - self._read_count
+
+  @property
+  def write_position(self) -> int:
+    return self._write_count
+
+  @property
+  def read_position(self) -> int:
+    return self._read_count
+
+  def peek(self, count: int) -> Optional[np.ndarray]:
+    if count > self.max_read:
+      raise ValueError(f'Cannot read {count} samples from a ring with max_read {self.max_read}')
+    with self._lock:
+      if self._write_count - self._read_count < count:
+        return None
+      self._peek_position = self._read_count
+      pos = self._read_count % self.capacity
+      view = self._buffer[:, pos:pos + count]
+      return view[0] if self.channels == 1 else view
+
+  def consume(self, count: int) -> None:
+    # Consumes relative to the last peek so samples dropped by the writer in the meantime
+    # are not counted twice.
+    with self._lock:
+      start = self._read_count if self._peek_position is None else self._peek_position
+      self._read_count = min(max(self._read_count, start + count), self._write_count)
+      self._peek_position = None
+
+  def read(self, count: int) -> Optional[np.ndarray]:
+    view = self.peek(count)
+    if view is not None:
+      self.consume(count)
+    return view
+
+  def read_history(self, start: int, max_count: int) -> tuple[int, np.ndarray]:
+    # Copies samples from an absolute position without consuming them. If start has already
+    # been overwritten the copy begins at the oldest retained sample, whose position is returned.
+    with self._lock:
+      start = min(max(start, self._write_count - self.capacity, 0), self._write_count)
+      count = min(max_count, self._write_count - start)
+      pos = start % self.capacity
+      first = min(count, self.capacity - pos)
+      history = np.concatenate([self._buffer[:, pos:pos + first], self._buffer[:, :count - first]], axis=1)
+      return start, history[0] if self.channels == 1 else history
+
+  def wait_for_position(self, position: int, timeout: Optional[float] = None) -> bool:
+    with self._data_available:
+      return self._data_available.wait_for(lambda: self._write_count > position, timeout=timeout)
+
+  def wait(self, count: int, timeout: Optional[float] = None) -> bool:
+    with self._data_available:
+      return self._data_available.wait_for(lambda: self._write_count - self._read_count >= count, timeout=timeout)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._read_count = self._write_count
+      self._peek_position = None
+
+  def get_stats(self) -> Dict[str, int]:
+    return {
+      'capacity': self.capacity,
+      'available': self.available,
+      'written_samples': self.written_samples,
+      'dropped_samples': self.dropped_samples,
+      'overflows': self.overflows,
+    }
+
+
+class SharedRingBuffer(RingBuffer):
+  # RingBuffer whose samples and read/write positions live in shared memory, so a producer
+  # and a consumer can be in different processes. Hand it to the other process as a Process
+  # argument; the owner unlinks the memory on close(). Drop/overflow counters are per process.
+  _POSITIONS_BYTES = 16
+
+  def __init__(self, capacity: int, channels: int = 1, max_read: Optional[int] = None, overflow_policy: str = DROP_OLDEST, context: Optional[Any] = None) -> None:
+    context = context or multiprocessing.get_context()
+    max_read = min(max_read or capacity, capacity)
+    self._shm = shared_memory.SharedMemory(create=True, size=self._POSITIONS_BYTES + channels * (capacity + max_read) * 2)
+    self._owner = True
+    self._attach(channels, capacity + max_read)
+    super().__init__(capacity, channels, max_read, overflow_policy)
+    # Replace the process-local storage and lock set up by RingBuffer
+    self._attach(channels, capacity + max_read)
+    self._buffer[:] = 0
+    self._lock = context.Lock()
+    self._data_available = context.Condition(self._lock)
+
+  def _attach(self, channels: int, length: int) -> None:
+    self._positions = np.ndarray((2,), dtype=np.int64, buffer=self._shm.buf)
+    self._buffer = np.ndarray((channels, length), dtype=np.int16, buffer=self._shm.buf, offset=self._POSITIONS_BYTES)
+
+  @property
+  def _write_count(self) -> int:
+    return int(self._positions[0])
+
+  @_write_count.setter
+  def _write_count(self, value: int) -> None:
+    self._positions[0] = value
+
+  @property
+  def _read_count(self) -> int:
+    return int(self._positions[1])
+
+  @_read_count.setter
+  def _read_count(self, value: int) -> None:
+    self._positions[1] = value
+
+  def __getstate__(self) -> Dict[str, Any]:
+    state = self.__dict__.copy()
+    for key in ('_shm', '_positions', '_buffer'):
+      del state[key]
+    state['_shm_name'] = self._shm.name
+    state['_owner'] = False
+    return state
+
+  def __setstate__(self, state: Dict[str, Any]) -> None:
+    shm_name = state.pop('_shm_name')
+    self.__dict__.update(state)
+    self._shm = shared_memory.SharedMemory(name=shm_name)
+    self._attach(self.channels, self.capacity + self.max_read)
+
+  def close(self) -> None:
+    self._positions = None
+    self._buffer = None
+    try:
+      self._shm.close()
+    except BufferError:
+      # A view handed out by peek() is still alive, the mapping goes when it is collected
+      pass
+    if self._owner:
+      self._shm.unlink()
+      self._owner = False
@@ -0,0 +1,55 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+
+def process_start_time() -> float:
+  # Process start on the time.monotonic() clock, so interpreter start-up and imports are counted
+  try:
+    with open('/proc/self/stat') as f:
+      # Fields after the executable name, which may itself contain spaces
+      fields = f.read().rsplit(')', 1)[1].split()
+    started_after_boot_s = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    return time.monotonic() - (time.clock_gettime(time.CLOCK_BOOTTIME) - started_after_boot_s)
+  except (OSError, ValueError, IndexError, AttributeError):
+    return time.monotonic()
+
+
+class StartupTimer:
+  # Start and end of each startup phase relative to process start. Phases may overlap
+  # since independent ones run concurrently, and may be recorded from any thread.
+  def __init__(self) -> None:
+    self.process_start = process_start_time()
+    self.phases: Dict[str, tuple[float, float]] = {}
+    self.ready_s: Optional[float] = None
+
+  def record(self, name: str, start: float) -> None:
+    self.phases[name] = (start - self.process_start, time.monotonic() - self.process_start)
+
+  @contextmanager
+  def phase(self, name: str) -> Iterator[None]:
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      self.record(name, start)
+
+  def ready(self) -> None:
+    self.ready_s = time.monotonic() - self.process_start
+    logging.info(f'Startup took {self.ready_s:.2f}s:\n{self.report()}')
+
+  def report(self) -> str:
+    lines = []
+    for name, (start_s, end_s) in sorted(self.phases.items(), key=lambda phase: phase[1][0]):
+      lines.append(f'  {name:<20} {start_s:6.2f}s -> {end_s:6.2f}s ({end_s - start_s:.2f}s)')
+    return '\n'.join(lines)
+
+  def get_stats(self) -> dict[str, float]:
+    stats = {f'{name}_s': end_s - start_s for name, (start_s, end_s) in self.phases.items()}
+    stats['ready_s'] = self.ready_s or 0.0
+    return stats
+
+
+startup_timer = StartupTimer()
@@ -0,0 +1,113 @@
+import numpy as np
+from typing import Optional
+from scipy.signal import lfilter, lfilter_zi, fftconvolve, get_window
+from noise_suppression import NoiseSuppressor
+
+
+def _triangle(n_grad: int) -> np.ndarray:
+  return np.concatenate([
+    np.linspace(0, 1, n_grad + 1, endpoint=False),
+    np.linspace(1, 0, n_grad + 2),
+  ])[1:-1]
+
+
+class StreamingSpectralGate(NoiseSuppressor):
+  # Streaming equivalent of noisereduce's SpectralGateNonStationary. The STFT overlap-add
+  # buffers, the recursive noise floor and the mask smoothing history are carried between
+  # calls so each hop goes through the STFT exactly once. The non-causal parts of the
+  # offline version (filtfilt noise floor, centred time smoothing of the mask) become a
+  # causal noise floor plus a few hops of lookahead, which sets the latency. Without
+  # smooth_mask the mask is used as computed, which roughly halves the cost and drops the
+  # lookahead at the price of more musical noise.
+  def __init__(
+    self,
+    sample_rate: int = 16000,
+    n_fft: int = 1024,
+    hop_length: Optional[int] = None,
+    time_constant_s: float = 0.256,
+    freq_mask_smooth_hz: float = 500,
+    time_mask_smooth_ms: float = 64,
+    thresh_n_mult: float = 4,
+    sigmoid_slope: float = 20,
+    prop_decrease: float = 0.7,
+    smooth_mask: bool = True,
+  ) -> None:
+    self.sample_rate = sample_rate
+    self.n_fft = n_fft
+    self.hop_length = hop_length or n_fft // 4
+    if self.n_fft % self.hop_length != 0:
+      raise ValueError('n_fft must be a multiple of hop_length')
+    self._overlap = self.n_fft // self.hop_length
+    self._thresh_n_mult = thresh_n_mult
+    self._sigmoid_slope = sigmoid_slope
+    self._prop_decrease = prop_decrease
+    self._smooth_mask = smooth_mask
+
+    self._window = get_window('hann', self.n_fft)
+    self._synthesis_window = self._window / np.sum(self._window ** 2 / self.hop_length)
+
+    t_frames = time_constant_s * sample_rate / float(self.hop_length)
+    b = (np.sqrt(1 + 4 * t_frames ** 2) - 1) / (2 * t_frames ** 2)
+    self._smooth_b = np.array([b])
+    self._smooth_a = np.array([1, b - 1])
+
+    n_grad_freq = max(1, int(freq_mask_smooth_hz / (sample_rate / (self.n_fft / 2))))
+    n_grad_time = max(1, int(time_mask_smooth_ms / ((self.hop_length / sample_rate) * 1000)))
+    freq_filter = _triangle(n_grad_freq)
+    time_filter = _triangle(n_grad_time)
+    self._freq_filter = (freq_filter / np.sum(freq_filter))[np.newaxis, :]
+    self._time_filter = (time_filter / np.sum(time_filter))[:, np.newaxis]
+    self._lookahead = len(time_filter) // 2 if smooth_mask else 0
+
+    self.latency = self.n_fft - self.hop_length + self._lookahead * self.hop_length
+    self.reset()
+
+  def reset(self) -> None:
+    n_bins = self.n_fft // 2 + 1
+    self._pending = np.zeros(0, dtype=np.float64)
+    self._input_tail = np.zeros(self.n_fft - self.hop_length, dtype=np.float64)
+    self._output_tail = np.zeros(self.n_fft - self.hop_length, dtype=np.float64)
+    self._noise_state: Optional[np.ndarray] = None
+    self._mask_history = np.zeros((2 * self._lookahead, n_bins), dtype=np.float64)
+    self._stft_history = np.zeros((self._lookahead, n_bins), dtype=np.complex128)
+
+  def process(self, audio: np.ndarray) -> np.ndarray:
+    samples = np.concatenate([self._pending, audio.astype(np.float64)])
+    n_hops = len(samples) // self.hop_length
+    self._pending = samples[n_hops * self.hop_length:]
+    if n_hops == 0:
+      return np.zeros(0, dtype=np.int16)
+
+    signal = np.concatenate([self._input_tail, samples[:n_hops * self.hop_length]])
+    self._input_tail = signal[-len(self._input_tail):]
+    frames = np.lib.stride_tricks.sliding_window_view(signal, self.n_fft)[::self.hop_length]
+    sig_stft = np.fft.rfft(frames * self._window, axis=1)
+    abs_sig_stft = np.abs(sig_stft)
+
+    if self._noise_state is None:
+      self._noise_state = lfilter_zi(self._smooth_b, self._smooth_a)[:, np.newaxis] * abs_sig_stft[0]
+    sig_stft_smooth, self._noise_state = lfilter(
+      self._smooth_b, self._smooth_a, abs_sig_stft, axis=0, zi=self._noise_state
+    )
+
+    sig_mult_above_thresh = (abs_sig_stft - sig_stft_smooth) / np.maximum(sig_stft_smooth, 1e-10)
+    sig_mask = 1 / (1 + np.exp(-(sig_mult_above_thresh - self._thresh_n_mult) * self._sigmoid_slope))
+    if self._smooth_mask:
+      sig_mask = fftconvolve(sig_mask, self._freq_filter, mode='same', axes=1)
+      mask_frames = np.concatenate([self._mask_history, sig_mask])
+      self._mask_history = mask_frames[len(mask_frames) - len(self._mask_history):]
+      sig_mask = fftconvolve(mask_frames, self._time_filter, mode='valid', axes=0)
+    sig_mask = sig_mask * self._prop_decrease + (1.0 - self._prop_decrease)
+
+    stft_frames = np.concatenate([self._stft_history, sig_stft])
+    self._stft_history = stft_frames[len(stft_frames) - len(self._stft_history):]
+    denoised_frames = np.fft.irfft(stft_frames[:n_hops] * sig_mask, n=self.n_fft, axis=1) * self._synthesis_window
+
+    output = np.zeros((n_hops + self._overlap - 1) * self.hop_length, dtype=np.float64)
+    for i in range(self._overlap):
+      segment = denoised_frames[:, i * self.hop_length:(i + 1) * self.hop_length].reshape(-1)
+      output[i * self.hop_length:i * self.hop_length + len(segment)] += segment
+    output[:len(self._output_tail)] += self._output_tail
+    self._output_tail = output[n_hops * self.hop_length:]
+
+    return np.clip(output[:n_hops * self.hop_length], -32768, 32767).astype(np.int16)
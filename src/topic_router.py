@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Generic, Optional, TypeVar
+import aiomqtt
+from metrics import metrics
+
+# What a subscription does with a message when its queue is full. BLOCK holds up the MQTT
+# read loop until there is room, for topics where every message matters.
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+DEFAULT_QUEUE_SIZE = 64
+
+Handler = Callable[[aiomqtt.Message], Awaitable[None]]
+T = TypeVar('T')
+
+
+class TopicTrie(Generic[T]):
+  # Topic filters split on '/', so matching a topic costs one walk per level instead of
+  # testing every filter. Supports the MQTT '+' (one level) and '#' (rest of topic) wildcards.
+  def __init__(self) -> None:
+    self._children: Dict[str, 'TopicTrie[T]'] = {}
+    self._values: list[T] = []
+
+  def insert(self, topic_filter: str, value: T) -> None:
+    node = self
+    for level in topic_filter.split('/'):
+      node = node._children.setdefault(level, TopicTrie())
+    node._values.append(value)
+
+  def remove(self, topic_filter: str, value: T) -> None:
+    path = [self]
+    for level in topic_filter.split('/'):
+      if level not in path[-1]._children:
+        return
+      path.append(path[-1]._children[level])
+    if value in path[-1]._values:
+      path[-1]._values.remove(value)
+    # Prune the branch back to the last node still in use
+    for level, (parent, node) in reversed(list(zip(topic_filter.split('/'), zip(path, path[1:])))):
+      if node._values or node._children:
+        break
+      del parent._children[level]
+
+  def match(self, topic: str) -> list[T]:
+    matches: list[T] = []
+    self._match(topic.split('/'), 0, matches)
+    return matches
+
+  def _match(self, levels: list[str], index: int, matches: list[T]) -> None:
+    if '#' in self._children:
+      matches.extend(self._children['#']._values)
+    if index == len(levels):
+      matches.extend(self._values)
+      return
+    for key in (levels[index], '+'):
+      child = self._children.get(key)
+      if child:
+        child._match(levels, index + 1, matches)
+
+
+class Subscription:
+  # One handler on one topic filter, with its own bounded queue and worker task so a slow
+  # handler only delays its own messages
+  def __init__(self, topic_filter: str, handler: Handler, max_queue: int, overflow_policy: str, name: str) -> None:
+    if overflow_policy not in OVERFLOW_POLICIES:
+      raise ValueError(f'Unknown overflow policy: {overflow_policy}')
+    self.topic_filter = topic_filter
+    self.handler = handler
+    self.max_queue = max_queue
+    self.overflow_policy = overflow_policy
+    self.name = name
+    self._messages: deque[tuple[aiomqtt.Message, float]] = deque()
+    self._messages_available = asyncio.Event()
+    self._space_available = asyncio.Event()
+    self._task = asyncio.create_task(self._worker())
+
+    self.received = 0
+    self.dropped = 0
+    self.max_backlog = 0
+    self._latency = metrics.histogram(f'mqtt.{name}.latency_ms')
+
+  async def put(self, message: aiomqtt.Message) -> None:
+    self.received += 1
+    if len(self._messages) >= self.max_queue:
+      if self.overflow_policy == DROP_NEWEST:
+        self.dropped += 1
+        return
+      if self.overflow_policy == DROP_OLDEST:
+        self._messages.popleft()
+        self.dropped += 1
+      else:
+        while len(self._messages) >= self.max_queue:
+          self._space_available.clear()
+          await self._space_available.wait()
+    self._messages.append((message, time.perf_counter()))
+    self.max_backlog = max(self.max_backlog, len(self._messages))
+    self._messages_available.set()
+
+  async def _worker(self) -> None:
+    while True:
+      if not self._messages:
+        self._messages_available.clear()
+        await self._messages_available.wait()
+        continue
+      message, received_time = self._messages.popleft()
+      self._space_available.set()
+      try:
+        await self.handler(message)
+      except Exception as e:
+        logging.error(f'Error in message handler for {message.topic}: {e}')
+      # From arrival to handled, so time spent queued behind other messages is included
+      self._latency.observe_since(received_time)
+
+  def close(self) -> None:
+    self._task.cancel()
+    self._messages.clear()
+    self._space_available.set()
+
+  def get_stats(self) -> dict[str, float]:
+    return {
+      'backlog': len(self._messages),
+      'max_backlog': self.max_backlog,
+      'received': self.received,
+      'dropped': self.dropped,
+    }
+
+
+class TopicRouter:
+  # Routes incoming messages to the subscriptions whose filter matches the topic
+  def __init__(self) -> None:
+    self._trie: TopicTrie[Subscription] = TopicTrie()
+    self._subscriptions: list[Subscription] = []
+
+  def add(self, topic_filter: str, handler: Handler, max_queue: int = DEFAULT_QUEUE_SIZE, overflow_policy: str = DROP_OLDEST, name: Optional[str] = None) -> None:
+    if any(s.topic_filter == topic_filter and s.handler == handler for s in self._subscriptions):
+      return
+    subscription = Subscription(topic_filter, handler, max_queue, overflow_policy, name or topic_filter)
+    self._trie.insert(topic_filter, subscription)
+    self._subscriptions.append(subscription)
+
+  def remove(self, topic_filter: str, handler: Handler) -> None:
+    for subscription in [s for s in self._subscriptions if s.topic_filter == topic_filter and s.handler == handler]:
+      self._trie.remove(topic_filter, subscription)
+      self._subscriptions.remove(subscription)
+      subscription.close()
+
+  async def dispatch(self, message: aiomqtt.Message) -> None:
+    for subscription in self._trie.match(str(message.topic)):
+      await subscription.put(message)
+
+  def get_stats(self) -> dict[str, float]:
+    stats: dict[str, float] = {}
+    for subscription in self._subscriptions:
+      for key, value in subscription.get_stats().items():
+        stats[f'{subscription.name}.{key}'] = value
+    return stats
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+SAMPLE_RATE = 16000
+SAMPLE_BYTES = 2
+UPLINK_PACKET_MS = int(os.getenv('UPLINK_PACKET_MS', '80'))
+UPLINK_QUEUE_SECONDS = 5.0
+# Under backpressure the newest queued packet absorbs new audio up to this many packets
+# worth of samples before the oldest queued packet is dropped
+UPLINK_MAX_MERGE_PACKETS = 4
+
+
+class UplinkPacket(NamedTuple):
+  sequence: int
+  audio: bytes
+  capture_time: float
+
+
+class UplinkSender:
+  def __init__(self, send: Callable[[bytes, float, int], Awaitable[None]], packet_ms: int = UPLINK_PACKET_MS) -> None:
+    self._send = send
+    self.packet_bytes = SAMPLE_RATE * packet_ms // 1000 * SAMPLE_BYTES
+    self.max_queue_packets = max(1, int(UPLINK_QUEUE_SECONDS * 1000 / packet_ms))
+    self._packets: deque[UplinkPacket] = deque()
+    self._packets_available = asyncio.Event()
+    self._is_open = asyncio.Event()
+    self._pending = bytearray()
+    self._pending_capture_time = 0.0
+    self._sequence = 0
+    self._task: Optional[asyncio.Task] = None
+
+    self.sent_packets = 0
+    self.merged_packets = 0
+    self.dropped_packets = 0
+    self.max_queue_depth = 0
+    self.last_send_latency_s = 0.0
+    self.avg_send_latency_s = 0.0
+    self.max_send_latency_s = 0.0
+
+  def start(self) -> None:
+    if not self._task:
+      self._task = asyncio.create_task(self._send_loop())
+
+  def begin(self) -> None:
+    self._is_open.clear()
+    self._packets.clear()
+    self._pending.clear()
+    self._sequence = 0
+
+  def open(self) -> None:
+    self._is_open.set()
+
+  def end(self) -> None:
+    self._is_open.clear()
+    self._packets.clear()
+    self._pending.clear()
+
+  def push(self, audio_data: bytes, capture_time: Optional[float] = None) -> None:
+    if not self._pending:
+      self._pending_capture_time = capture_time if capture_time is not None else time.time() - len(audio_data) / SAMPLE_BYTES / SAMPLE_RATE
+    self._pending += audio_data
+    while len(self._pending) >= self.packet_bytes:
+      packet_audio = bytes(self._pending[:self.packet_bytes])
+      del self._pending[:self.packet_bytes]
+      self._enqueue(packet_audio, self._pending_capture_time)
+      self._pending_capture_time += self.packet_bytes / SAMPLE_BYTES / SAMPLE_RATE
+
+  def _enqueue(self, audio: bytes, capture_time: float) -> None:
+    if len(self._packets) >= self.max_queue_packets:
+      newest = self._packets[-1]
+      if len(newest.audio) + len(audio) <= self.packet_bytes * UPLINK_MAX_MERGE_PACKETS:
+        self._packets[-1] = newest._replace(audio=newest.audio + audio)
+        self.merged_packets += 1
+        return
+      self._packets.popleft()
+      self.dropped_packets += 1
+
+    self._packets.append(UplinkPacket(self._sequence, audio, capture_time))
+    self._sequence += 1
+    self.max_queue_depth = max(self.max_queue_depth, len(self._packets))
+    self._packets_available.set()
+
+  async def _send_loop(self) -> None:
+    while True:
+      await self._is_open.wait()
+      if not self._packets:
+        self._packets_available.clear()
+        await self._packets_available.wait()
+        continue
+
+      packet = self._packets.popleft()
+      start = time.perf_counter()
+      try:
+        await self._send(packet.audio, packet.capture_time, packet.sequence)
+      except Exception as e:
+        logging.error(f'Failed to send uplink packet {packet.sequence}: {e}')
+        continue
+      self._record_latency(time.perf_counter() - start)
+
+  def _record_latency(self, latency_s: float) -> None:
+    self.sent_packets += 1
+    self.last_send_latency_s = latency_s
+    self.max_send_latency_s = max(self.max_send_latency_s, latency_s)
+    self.avg_send_latency_s += (latency_s - self.avg_send_latency_s) * 0.05
+
+  def get_stats(self) -> dict[str, float]:
+    return {
+      'queue_depth': len(self._packets),
+      'max_queue_depth': self.max_queue_depth,
+      'sent_packets': self.sent_packets,
+      'merged_packets': self.merged_packets,
+      'dropped_packets': self.dropped_packets,
+      'last_send_latency_ms': self.last_send_latency_s * 1000,
+      'avg_send_latency_ms': self.avg_send_latency_s * 1000,
+      'max_send_latency_ms': self.max_send_latency_s * 1000,
+    }
@@ -3,47 +3,175 @@ import time
 import json
 import logging
 import socket
-from typing import Optional
+from typing import Optional, Dict
 import aiomqtt
 from mqtt import MqttConnection
+from publish_queue import PRIORITY_CONTROL, PRIORITY_NORMAL
 
 ARBITRATION_WINDOW = 0.3
 ARBITRATION_TIMEOUT = 5.0
+HEARTBEAT_INTERVAL = 10.0
+PEER_TIMEOUT = HEARTBEAT_INTERVAL * 3
 DEVICE_ID = socket.gethostname()
+WAKE_TOPIC = 'voicenode/wake'
+PRESENCE_TOPIC = 'voicenode/presence'
+
+
+class ArbitrationRound:
+  # All wake triggers seen for one utterance. Times are local monotonic receipt times and
+  # order is the order messages were relayed by the broker, which every node sees the same
+  # way, so no wall clocks are compared across hosts.
+  def __init__(self) -> None:
+    self.started_at = time.monotonic()
+    self.triggers: Dict[str, tuple[float, int]] = {}
+    self.decided = False
+
+  def is_open(self) -> bool:
+    return not self.decided and time.monotonic() - self.started_at < ARBITRATION_WINDOW
+
+  def is_late(self, device_id: str) -> bool:
+    # After the round closes a device that hasn't triggered yet is taken to be late for the
+    # same utterance, while one that already has is on to a new one
+    return device_id not in self.triggers and time.monotonic() - self.started_at < ARBITRATION_TIMEOUT
+
+  def add_trigger(self, device_id: str, confidence: float) -> None:
+    if device_id not in self.triggers:
+      self.triggers[device_id] = (confidence, len(self.triggers))
+
+  def winner(self) -> Optional[str]:
+    if not self.triggers:
+      return None
+    return max(self.triggers, key=lambda device_id: (self.triggers[device_id][0], -self.triggers[device_id][1]))
+
 
 class WakeArbitration:
   def __init__(self, mqtt: MqttConnection) -> None:
     self._mqtt = mqtt
-    self._latest_trigger: Optional[dict] = None
+    self._peers: Dict[str, float] = {}
+    self._round: Optional[ArbitrationRound] = None
+    # Round this node last claimed in, which the broker's echo of that claim belongs to
+    self._claim_round: Optional[ArbitrationRound] = None
+    self._round_updated = asyncio.Event()
+    self._heartbeat_task: Optional[asyncio.Task] = None
+    # Peers decide once their window closes, so a later wake claim is useless. Likewise a
+    # heartbeat once the next is due.
+    mqtt.set_publish_policy(WAKE_TOPIC, PRIORITY_CONTROL, ARBITRATION_WINDOW)
+    mqtt.set_publish_policy(f'{PRESENCE_TOPIC}/+', PRIORITY_NORMAL, HEARTBEAT_INTERVAL)
+
+  def presence_will(self) -> aiomqtt.Will:
+    return aiomqtt.Will(f'{PRESENCE_TOPIC}/{DEVICE_ID}', json.dumps({'deviceId': DEVICE_ID, 'online': False}), qos=1, retain=True)
 
   async def connect(self) -> None:
-    await self._mqtt.subscribe("voicenode/wake")
-    self._mqtt.register_handler("voicenode/wake", self._handle_wake_message)
+    await self._mqtt.subscribe(WAKE_TOPIC)
+    self._mqtt.register_handler(WAKE_TOPIC, self._handle_wake_message)
+    await self._mqtt.subscribe(f'{PRESENCE_TOPIC}/+')
+    self._mqtt.register_handler(f'{PRESENCE_TOPIC}/+', self._handle_presence_message)
+    if not self._heartbeat_task:
+      self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
 
-  async def _handle_wake_message(self, message: aiomqtt.Message) -> None:
+  async def _heartbeat_loop(self) -> None:
+    while True:
+      try:
+        await self._mqtt.publish(f'{PRESENCE_TOPIC}/{DEVICE_ID}', json.dumps({
+          'deviceId': DEVICE_ID,
+          'online': True,
+          'heartbeatInterval': HEARTBEAT_INTERVAL,
+        }), retain=True)
+      except Exception as e:
+        logging.warning(f'Failed to publish presence: {e}')
+      await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+  async def _handle_presence_message(self, message: aiomqtt.Message) -> None:
     if not message.payload:
       return
-    self._latest_trigger = json.loads(message.payload.decode())
+    presence = json.loads(message.payload.decode())
+    device_id = presence['deviceId']
+    if device_id == DEVICE_ID:
+      return
+    if presence.get('online'):
+      if device_id not in self._peers:
+        logging.info(f'Voice node peer online: {device_id}')
+      self._peers[device_id] = time.monotonic()
+    elif self._peers.pop(device_id, None) is not None:
+      logging.info(f'Voice node peer offline: {device_id}')
+
+  def active_peers(self) -> set[str]:
+    now = time.monotonic()
+    return {device_id for device_id, last_seen in self._peers.items() if now - last_seen < PEER_TIMEOUT}
+
+  async def _handle_wake_message(self, message: aiomqtt.Message) -> None:
+    # Retained triggers are from an old round and would only skew the broker ordering
+    if not message.payload or message.retain:
+      return
+    trigger = json.loads(message.payload.decode())
+    device_id = trigger['deviceId']
+    if device_id == DEVICE_ID:
+      if self._claim_round:
+        self._claim_round.add_trigger(device_id, trigger['confidence'])
+        self._round_updated.set()
+      return
+    arbitration_round = self._round
+    if arbitration_round and not arbitration_round.is_open():
+      if arbitration_round.is_late(device_id):
+        # Recorded so a later trigger from the same device starts a new round
+        arbitration_round.add_trigger(device_id, trigger['confidence'])
+        return
+      arbitration_round = None
+    if not arbitration_round:
+      arbitration_round = self._round = ArbitrationRound()
+    arbitration_round.add_trigger(device_id, trigger['confidence'])
+    self._round_updated.set()
+
+  def _try_resolve(self, arbitration_round: ArbitrationRound, confidence: float) -> Optional[bool]:
+    for device_id, (peer_confidence, _) in arbitration_round.triggers.items():
+      if device_id != DEVICE_ID and peer_confidence > confidence:
+        logging.info(f'Lost arbitration to {device_id} ({peer_confidence})')
+        return False
+    if DEVICE_ID in arbitration_round.triggers and self.active_peers() <= set(arbitration_round.triggers):
+      return arbitration_round.winner() == DEVICE_ID
+    return None
 
   async def should_handle_request(self, confidence: float) -> bool:
     logging.info(f'Arbitrating with confidence {confidence}')
+    start = time.monotonic()
 
-    if self._latest_trigger and self._latest_trigger['deviceId'] != DEVICE_ID:
-      trigger_age = time.time() - self._latest_trigger['timestamp']
-      if trigger_age < ARBITRATION_WINDOW:
-        if confidence <= self._latest_trigger['confidence']:
-          logging.info(f'Lost arbitration to {self._latest_trigger}')
-          return False
-      elif trigger_age < ARBITRATION_TIMEOUT:
-        logging.info(f'Another device already handling request: {self._latest_trigger}')
+    arbitration_round = self._round
+    if arbitration_round and not arbitration_round.is_open():
+      if arbitration_round is not self._claim_round and arbitration_round.is_late(DEVICE_ID):
+        logging.info(f'Another device already handling request: {arbitration_round.winner()}')
         return False
+      arbitration_round = None
+    if arbitration_round and DEVICE_ID in arbitration_round.triggers:
+      logging.info('Already arbitrated for this wake word')
+      return False
+    if not arbitration_round:
+      arbitration_round = self._round = ArbitrationRound()
+    self._claim_round = arbitration_round
 
-    await self._mqtt.publish("voicenode/wake", json.dumps({
+    # Not waited on, so while the broker is away the window still closes on time and the
+    # node answers its own wake word rather than going deaf until it reconnects
+    await self._mqtt.publish(WAKE_TOPIC, json.dumps({
       'deviceId': DEVICE_ID,
       'confidence': confidence,
-      'timestamp': time.time()
-    }), retain=True)
+    }), wait=False)
+
+    decision: Optional[bool] = None
+    while decision is None:
+      decision = self._try_resolve(arbitration_round, confidence)
+      remaining = arbitration_round.started_at + ARBITRATION_WINDOW - time.monotonic()
+      if decision is not None or remaining <= 0:
+        break
+      self._round_updated.clear()
+      try:
+        await asyncio.wait_for(self._round_updated.wait(), timeout=remaining)
+      except asyncio.TimeoutError:
+        pass
 
-    await asyncio.sleep(ARBITRATION_WINDOW + 0.1)
+    if decision is None:
+      # Window closed without hearing back from every peer, so go with what was received
+      arbitration_round.add_trigger(DEVICE_ID, confidence)
+      decision = arbitration_round.winner() == DEVICE_ID
+    arbitration_round.decided = True
 
-    return self._latest_trigger['deviceId'] == DEVICE_ID
+    logging.info(f'Arbitration {"won" if decision else "lost"} in {(time.monotonic() - start) * 1000:.0f}ms')
+    return decision
@@ -1,34 +1,254 @@
+import asyncio
+import copy
+import os
 import platform
 import logging
+import queue
+import threading
+import time
 import numpy as np
-from typing import Optional
+from collections import deque
+from typing import Dict, Optional, NamedTuple
+from energy_gate import EnergyGate
+from metrics import metrics
 
 THRESHOLD = 0.5
+PATIENCE_FRAMES = 1
+COOLDOWN_S = 2.0
 FRAMEWORK = 'onnx' if platform.system() == 'Windows' else 'tflite'
+SAMPLE_RATE = 16000
+# openwakeword scores one prediction per 80ms of audio
+MODEL_FRAME_SIZE = 1280
+# Comma separated name[:threshold[:patience frames[:cooldown seconds]]], e.g. Hola_casita:0.5,hey_jarvis:0.6:2
+WAKEWORD_MODELS = os.getenv('WAKEWORD_MODELS', 'Hola_casita')
+# Capture tap the detector listens on (audioprocessor.TAP_STAGES). The AEC tap skips the NR
+# latency, and with AUDIO_LOW_LATENCY=1 the 256ms processing blocks too. Raw is the earliest
+# but also hears the node's own playback.
+WAKEWORD_TAP = os.getenv('WAKEWORD_TAP', 'aec')
+# Silence run through the model at startup, enough to fill its 16 frame feature window
+WARMUP_SECONDS = 2.0
+INFERENCE_BACKLOG_FRAMES = 8
+PREGATE_ENABLED = os.getenv('WAKEWORD_PREGATE', '1') == '1'
+PREGATE_CONTEXT_S = 1.5
+
+
+class WakeWordConfig(NamedTuple):
+  name: str
+  threshold: float = THRESHOLD
+  # Consecutive 80ms frames that must score above the threshold
+  patience: int = PATIENCE_FRAMES
+  # Audio after a detection during which the same wake word can't fire again
+  cooldown_s: float = COOLDOWN_S
+
+
+def parse_wakeword_models(spec: str) -> list[WakeWordConfig]:
+  configs = []
+  for entry in spec.split(','):
+    if not entry.strip():
+      continue
+    name, *options = entry.strip().split(':')
+    configs.append(WakeWordConfig(
+      name,
+      float(options[0]) if len(options) > 0 else THRESHOLD,
+      int(options[1]) if len(options) > 1 else PATIENCE_FRAMES,
+      float(options[2]) if len(options) > 2 else COOLDOWN_S,
+    ))
+  return configs
+
+
+class WakeDetection(NamedTuple):
+  score: float
+  # Absolute capture position (in samples) of the end of the frame that triggered
+  end_position: int
+  wake_word: str = ''
 
 
 class WakeWordDetector:
-  def __init__(self) -> None:
+  # All wake words are loaded into one openwakeword Model, which computes the melspectrogram
+  # and speech embeddings once per frame and shares them between the models, so each extra
+  # wake word only adds its classifier head. Threshold, patience and cooldown are per model.
+  def __init__(self, wake_words: Optional[list[WakeWordConfig]] = None) -> None:
     from openwakeword.model import Model
-    self.model = Model(wakeword_models=[f'Hola_casita.{FRAMEWORK}'], inference_framework=FRAMEWORK)
+    self.wake_words = {config.name: config for config in (wake_words or parse_wakeword_models(WAKEWORD_MODELS))}
+    self.model = Model(wakeword_models=[f'{name}.{FRAMEWORK}' for name in self.wake_words], inference_framework=FRAMEWORK)
+    self._frames_above_threshold: Dict[str, int] = {name: 0 for name in self.wake_words}
+    self._cooldown_until: Dict[str, int] = {}
+    self._detection_counts = {name: metrics.counter(f'wakeword.detections.{name}') for name in self.wake_words}
+    self._warm_state = self._warm_up()
+
+    self._frames: queue.Queue[tuple[bytes, int]] = queue.Queue(maxsize=INFERENCE_BACKLOG_FRAMES)
+    self._detections: asyncio.Queue[WakeDetection] = asyncio.Queue(maxsize=1)
+    self._loop: Optional[asyncio.AbstractEventLoop] = None
+    self._listening = threading.Event()
+    self._reset_requested = threading.Event()
 
-  def detect(self, audio_data: bytes) -> Optional[float]:
+    self._gate: Optional[EnergyGate] = EnergyGate(sample_rate=SAMPLE_RATE) if PREGATE_ENABLED else None
+    self._gate_context: deque[bytes] = deque()
+    self._gate_context_samples = 0
+
+    self.processed_frames = 0
+    self.dropped_frames = 0
+    self.last_inference_s = 0.0
+    self.max_inference_s = 0.0
+    self.avg_inference_s = 0.0
+    self.last_frame_budget_s = 0.0
+    self._inference_time = metrics.histogram('wakeword.inference_ms')
+    metrics.add_source('wakeword', self.get_stats)
+
+    self._worker = threading.Thread(target=self._inference_loop, daemon=True)
+    self._worker.start()
+
+  def detect(self, audio_data: bytes, end_position: int = 0) -> Optional[WakeDetection]:
     data = np.frombuffer(audio_data, dtype=np.int16)
     predictions = self.model.predict(data)
-    prediction = max(predictions.values())
+    # Frames longer than 80ms are scored as the max over their 80ms windows
+    model_frames = max(1, len(data) // MODEL_FRAME_SIZE)
 
-    if prediction > 0.1:
-      logging.info(f"Wake word prediction: {prediction:.3f}")
+    detection: Optional[WakeDetection] = None
+    for name, config in self.wake_words.items():
+      prediction = float(predictions.get(name, 0.0))
+      if prediction > 0.1:
+        logging.info(f"Wake word prediction {name}: {prediction:.3f}")
 
-    if prediction > THRESHOLD:
-      return float(prediction)
-    else:
-      return None
+      if prediction <= config.threshold:
+        self._frames_above_threshold[name] = 0
+        continue
+      self._frames_above_threshold[name] += model_frames
+      if self._frames_above_threshold[name] < config.patience or end_position < self._cooldown_until.get(name, 0):
+        continue
+      if not detection or prediction > detection.score:
+        detection = WakeDetection(prediction, end_position, name)
 
-  def reset(self) -> None:
+    if detection:
+      config = self.wake_words[detection.wake_word]
+      self._cooldown_until[detection.wake_word] = end_position + int(config.cooldown_s * SAMPLE_RATE)
+      self._frames_above_threshold[detection.wake_word] = 0
+      self._detection_counts[detection.wake_word].inc()
+    return detection
+
+  def _warm_up(self) -> dict:
+    # Runs the model on silence once and keeps the resulting state, so reset() can restore a
+    # primed model without inference. This also replaces the blank predictions needed before
+    # openwakeword 0.6.0 (https://github.com/dscripka/openWakeWord/pull/116), whose reset()
+    # leaves the feature buffers alone and zeroes the first 5 predictions after it.
     self.model.reset()
+    silence = np.zeros(MODEL_FRAME_SIZE, dtype=np.int16)
+    # One frame per call, each call adds one entry to the prediction buffer
+    for _ in range(int(WARMUP_SECONDS * SAMPLE_RATE) // MODEL_FRAME_SIZE):
+      self.model.predict(silence)
+    preprocessor = self.model.preprocessor
+    return {
+      # The melspectrogram only looks back a frame and a bit, a second is plenty
+      'raw_data_buffer': list(preprocessor.raw_data_buffer)[-SAMPLE_RATE:],
+      'melspectrogram_buffer': preprocessor.melspectrogram_buffer.copy(),
+      'feature_buffer': preprocessor.feature_buffer.copy(),
+      'prediction_buffer': copy.deepcopy(self.model.prediction_buffer),
+    }
+
+  def reset(self) -> None:
+    preprocessor = self.model.preprocessor
+    preprocessor.raw_data_buffer.clear()
+    preprocessor.raw_data_buffer.extend(self._warm_state['raw_data_buffer'])
+    preprocessor.melspectrogram_buffer = self._warm_state['melspectrogram_buffer'].copy()
+    preprocessor.feature_buffer = self._warm_state['feature_buffer'].copy()
+    preprocessor.accumulated_samples = 0
+    preprocessor.raw_data_remainder = np.empty(0)
+    self.model.prediction_buffer = copy.deepcopy(self._warm_state['prediction_buffer'])
+    for name in self._frames_above_threshold:
+      self._frames_above_threshold[name] = 0
+    # Otherwise audio from before the last session would be replayed into the model when the gate next opens
+    if self._gate:
+      self._gate.reset()
+    self._gate_context.clear()
+    self._gate_context_samples = 0
+
+  def feed(self, audio_data: bytes, position: int) -> None:
+    # Called from the audio callback or processing thread (see WAKEWORD_TAP), so this must never block
+    if not self._listening.is_set():
+      return
+    while True:
+      try:
+        self._frames.put_nowait((audio_data, position))
+        return
+      except queue.Full:
+        try:
+          self._frames.get_nowait()
+          self.dropped_frames += 1
+        except queue.Empty:
+          pass
+
+  def start_listening(self) -> None:
+    self._loop = asyncio.get_running_loop()
+    while not self._detections.empty():
+      self._detections.get_nowait()
+    self._reset_requested.set()
+    self._listening.set()
+
+  def stop_listening(self) -> None:
+    self._listening.clear()
+
+  async def wait_for_detection(self) -> WakeDetection:
+    return await self._detections.get()
+
+  def _deliver(self, detection: WakeDetection) -> None:
+    if self._listening.is_set() and not self._detections.full():
+      self._detections.put_nowait(detection)
+
+  def _inference_loop(self) -> None:
+    while True:
+      audio_data, position = self._frames.get()
+      if self._reset_requested.is_set():
+        self._reset_requested.clear()
+        self.reset()
+
+      if self._gate and not self._should_run_inference(audio_data):
+        continue
+
+      start = time.perf_counter()
+      try:
+        detection = self.detect(audio_data, position + len(audio_data) // 2)
+      except Exception as e:
+        logging.error(f'Wake word inference failed: {e}')
+        continue
+      self._record_latency(time.perf_counter() - start, len(audio_data) / 2 / SAMPLE_RATE)
+
+      if detection and self._loop:
+        logging.info(f'Wake word {detection.wake_word} detected ({detection.score:.3f})')
+        self._loop.call_soon_threadsafe(self._deliver, detection)
+
+  def _should_run_inference(self, audio_data: bytes) -> bool:
+    was_open = self._gate.is_open
+    if not self._gate.process(np.frombuffer(audio_data, dtype=np.int16)):
+      self._gate_context.append(audio_data)
+      self._gate_context_samples += len(audio_data) // 2
+      while self._gate_context_samples - len(self._gate_context[0]) // 2 >= PREGATE_CONTEXT_S * SAMPLE_RATE:
+        self._gate_context_samples -= len(self._gate_context.popleft()) // 2
+      return False
+
+    if not was_open:
+      # Prime the model with the audio leading up to the speech so its feature windows are current
+      for context_data in self._gate_context:
+        self.model.predict(np.frombuffer(context_data, dtype=np.int16))
+      self._gate_context.clear()
+      self._gate_context_samples = 0
+    return True
+
+  def _record_latency(self, inference_s: float, frame_budget_s: float) -> None:
+    self.processed_frames += 1
+    self._inference_time.observe(inference_s * 1000)
+    self.last_inference_s = inference_s
+    self.last_frame_budget_s = frame_budget_s
+    self.max_inference_s = max(self.max_inference_s, inference_s)
+    self.avg_inference_s += (inference_s - self.avg_inference_s) * 0.05
 
-    # This is a hack for a bug that is fixed in v0.6.0: https://github.com/dscripka/openWakeWord/pull/116
-    blank_buffer = b'\x00' * (1024 * 2)  # 16-bit samples = 2 bytes each
-    for _ in range(5):
-      self.model.predict(np.frombuffer(blank_buffer, dtype=np.int16))
+  def get_stats(self) -> dict[str, float]:
+    return {
+      'processed_frames': self.processed_frames,
+      'dropped_frames': self.dropped_frames,
+      'backlog_frames': self._frames.qsize(),
+      'last_inference_ms': self.last_inference_s * 1000,
+      'avg_inference_ms': self.avg_inference_s * 1000,
+      'max_inference_ms': self.max_inference_s * 1000,
+      'frame_budget_ms': self.last_frame_budget_s * 1000,
+      'pregate_skipped_fraction': self._gate.skipped_fraction() if self._gate else 0.0,
+    }